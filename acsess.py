@@ -18,8 +18,9 @@ import output
 from output import stats
 import objective
 from helpers import DumpMols, FinishSelection
-from distance import AveNNDistance
-from similarity import NNSimilarity
+from distance import LibraryDiversity, CompactCoords, SetGeneration
+from distance import SnapshotCoords, SaveBasis
+from similarity import NNSimilarity, ClearSimCache
 
 # set global variables:
 _iterhead = "\n-------------------- Iteration {0} ----------------\n"
@@ -56,6 +57,10 @@ def evolve():
 
         # 1. PRELOGGING
         print _iterhead.format(gen)
+        if mprms._similarity:
+            ClearSimCache()
+        else:
+            SetGeneration(gen)
         stats.update({'gen': gen, 'nPool': len(pool), 'nLib': len(lib)})
 
         # 2.MUTATIONS AND CROSSOVERS
@@ -103,8 +108,9 @@ def evolve():
             else:
                 # library diversity should not be assessed by normalization of only
                 # the lib. so either no normalization or a normalization based on 
-                # the whole pool.
-                siml = AveNNDistance(lib, norm=False)
+                # the whole pool. (a sampled estimate between the write steps)
+                exact = gen % mprms.writeInterval == 0 or gen == mprms.nGen - 1
+                siml, stats['diversitySE'] = LibraryDiversity(lib, exact)
         print '\nLIBRARY DIVERSITY: ', siml
 
         # 7. POSTLOGGING
@@ -113,7 +119,12 @@ def evolve():
                 f.write(Chem.MolToSmiles(mol) + ' {:d}\n'.format(i))
         if gen % mprms.writeInterval == 0 or gen == mprms.nGen - 1:
             DumpMols(lib, gen)
+            if not mprms._similarity:
+                SaveBasis()
         DumpMols(pool)
+        if not mprms._similarity:
+            SnapshotCoords(lib + pool, gen, final=gen == mprms.nGen - 1)
+            CompactCoords(lib + pool)
         stats['diversity'] = siml
         output.PrintTimings()
         output.PrintStat()
@@ -6,7 +6,7 @@ import parallel as pl
 import mprms
 import output as oput
 from distance import HandleMolCoords as GetCoords
-from distance import SetCoords, ScatterCoords
+from distance import SetCoords, ScatterCoords, GetCoordArray
 from rdkithelpers import *
 #import Coords as crd
 import drivers as dr
@@ -95,16 +95,9 @@ class Grid(object):
 
     @staticmethod
     def CoordArray(mols):
-        try:
-            # I interchanged these two rows
-            coords=[SetCoords(m) for m in mols ]
-            ndim=len(GetListProp(mols[0], 'coords'))
-            #ndim=len(mols[0].GetProp('coords'))
-        except AttributeError: coords=mols
-        except ValueError:
-            # Jos added this. because of:
-            # ValueError: GetProp: coords not found.
-            coords=mols
+        if len(mols)>0 and isinstance(mols[0], Chem.Mol):
+            coords=GetCoordArray(mols)
+        else: coords=mols
 
         if not issubclass( type(coords), np.ndarray ):
             outarray=np.empty( (len(coords),len(coords[0]) ) )
@@ -120,11 +113,14 @@ class PCAGrid(Grid):
                  pcabasis=None, scaleBins=False):
         coords=self.CoordArray(mols)
 
+        # only the grid dimensions are needed, the normalization of
+        # molecules comes from running moments of their own (the molecules
+        # of the grid are not those of the selection)
         if pcabasis is None:
-            pcdecomp = PCA(coords,norm=True)
+            pcdecomp = PCA(mols, nVectors=ndims, norm=True, moments='cells')
         else:
-            pcdecomp = PCA( self.CoordArray(pcabasis),
-                            norm=True )
+            pcdecomp = PCA(pcabasis, nVectors=ndims, norm=True,
+                           moments='cells')
             
         self.pcdecomp=pcdecomp
         
@@ -328,7 +324,7 @@ def ScatterAssign(mols):
     else:
         print 'Scattering grid assignments ...'
         scatter=[ (grid,
-                   [m.GetProp('coords') for m in toassign[i:i+ChunkSize] ] )
+                   GetCoordArray(toassign[i:i+ChunkSize]) )
                   for i in xrange(0,len(toassign),ChunkSize ) ]
         if pl.verbose:
             print len(scatter)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+In-memory store for the descriptor coordinates of molecules.
+
+All coordinates live in one contiguous float array, one row per molecule,
+with the row index keyed by isosmi. Compared to the old space-joined string
+properties this saves the formatting and parsing every time coordinates
+are needed, and about 10x memory per molecule. Rows are appended; Compact
+drops the rows of molecules that are gone.
+'''
+import numpy as np
+
+from rdkit import Chem
+
+
+def MolKey(mol):
+    if mol.HasProp('isosmi'):
+        return mol.GetProp('isosmi')
+    return Chem.MolToSmiles(mol, True)
+
+
+class CoordStore(object):
+    def __init__(self, growby=10000):
+        self.growby = growby
+        self.index = {}
+        self.nrows = 0
+        self.data = None
+
+    def __len__(self):
+        return self.nrows
+
+    def __contains__(self, mol):
+        return MolKey(mol) in self.index
+
+    def Add(self, mol, coord):
+        ''' store coord as the coordinates of mol, returns the row '''
+        coord = np.asarray(coord, dtype=float)
+        key = MolKey(mol)
+        if key in self.index:
+            self.data[self.index[key]] = coord
+            return self.index[key]
+        if self.data is None:
+            self.data = np.empty((self.growby, len(coord)))
+        elif self.nrows >= len(self.data):
+            newdata = np.empty((len(self.data) + max(self.growby, self.nrows),
+                                self.data.shape[1]))
+            newdata[:self.nrows] = self.data[:self.nrows]
+            self.data = newdata
+        self.data[self.nrows] = coord
+        self.index[key] = self.nrows
+        self.nrows += 1
+        return self.nrows - 1
+
+    def Row(self, mol):
+        ''' coordinates of mol (a view, KeyError if not stored) '''
+        return self.data[self.index[MolKey(mol)]]
+
+    def Rows(self, mols):
+        return np.array([self.index[MolKey(mol)] for mol in mols], dtype=int)
+
+    def Coords(self, mols):
+        ''' (len(mols), ndim) array with the coordinates of mols '''
+        if len(mols) == 0:
+            return np.zeros((0, 0 if self.data is None else self.data.shape[1]))
+        return self.data[self.Rows(mols)]
+
+    def Compact(self, mols):
+        ''' keep only the rows of mols '''
+        keys = set(MolKey(mol) for mol in mols)
+        keep = sorted(self.index[key] for key in keys if key in self.index)
+        if len(keep) == self.nrows:
+            return
+        rowkeys = dict((row, key) for key, row in self.index.iteritems())
+        data = np.empty((max(len(keep), 1), self.data.shape[1]))
+        data[:len(keep)] = self.data[keep]
+        self.index = dict((rowkeys[row], i) for i, row in enumerate(keep))
+        self.data = data
+        self.nrows = len(keep)
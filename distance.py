@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
+import os
+import threading
 import numpy as np
 from pcadimreduction import PCA
 from scipy.spatial.distance import cdist
@@ -9,9 +11,14 @@ from rdkit import Chem
 from rdkit.Chem import AllChem
 from rdkithelpers import *
 
+import mprms
 import parallel as pl
 import mongoserver
 import output
+import distkernel
+import rpforest
+from coordstore import CoordStore, MolKey
+from helpers import Enpickle, Depickle
 
 metric = None
 normCoords = True
@@ -20,6 +27,48 @@ extender = lambda mol:[]
 extender.__name__='extender'
 extendVariance = []
 dimRed=0
+# PCA basis of the dimRed selection space: 'refit' on every selection,
+# 'once', 'every' dimRedRefit generations, or 'incremental' (partial fits
+# on the molecules new to the pool). Saved to dimRedFile for restarts, see
+# SaveBasis.
+dimRedBasis = 'refit'
+dimRedRefit = 10
+dimRedFile = 'pcabasis.p'
+_basis = None
+_generation = 0
+sphereRadius = None  # sphere exclusion radius, None: calibrated
+# warm-started Maximin for the per generation selections: the previous
+# selection is reused as far as it is valid, with a cold start every
+# warmStart selections (0: always cold)
+warmStart = 0
+_warmstate = {}
+outOfCoreChunk = 65536  # rows per chunk of memory mapped coordinates
+# local worker processes for the regions of PCAMaximin without MPI
+nWorkers = 1
+# AveNNDistance queries a KD-tree instead of the brute force search for
+# coordinates with up to kdTreeMaxDim dimensions and kdTreeMinSize rows
+kdTreeMaxDim = 16
+kdTreeMinSize = 1000
+# above kdTreeMaxDim, nearest neighbor searches against at least
+# annMinSize points use an approximate random projection forest, built
+# for a recall of annRecall (0: always exact)
+annMinSize = 0
+annRecall = 0.95
+# library diversity estimated from this many sampled molecules, exact
+# only every writeInterval generations (0: always exact)
+diversitySample = 0
+# library diversity from an NNTracker that only updates the nearest
+# neighbors affected by the molecules that came and went
+incrementalNN = False
+_nntracker = None
+_moments = {}  # RunningMoments of the normalizations, by name
+# snapshot of the coordinates of library and pool every snapshotInterval
+# generations (0: never), see SnapshotCoords
+snapshotInterval = 0
+_snapshot = None  # writer thread of the last snapshot
+# coordinates of all molecules, keyed by isosmi. Only kept by the master
+# and not saved, a restart computes them again.
+coordstore = CoordStore()
 
 '''
 this module include various previous modules that corresponds to chemical space
@@ -59,24 +108,39 @@ def Init():
     else:
         raise KeyError('Unknown metric specified in parameter file: ' + metric)
 
+    if (getattr(mprms, 'restart', False) and dimRed > 0 and
+            os.path.isfile(dimRedFile)):
+        LoadBasis(dimRedFile)
 
-# Get coordinates
-def SetCoords(mol):
-    # set the coordinate of the molecule and return as a np.array object
-    # if not, calculate first and then assign it as a property of the molecule
-    if mol.HasProp('coords'):
-        coord = GetListProp(mol, 'coords')
-    else:
-        coord = Coords(mol)
 
-        # this would be a good position for a coordinate extension.
-        if extendCoords:
-            extension = extender(mol)
-            coord = np.append(coord, extension)
+def SetGeneration(gen):
+    ''' current generation, for the refits of the dimRed basis '''
+    global _generation
+    _generation = gen
+
+
+def CalcCoords(mol):
+    # calculate the coordinates of the molecule, without storing them
+    coord = Coords(mol)
+
+    # this would be a good position for a coordinate extension.
+    if extendCoords:
+        extension = extender(mol)
+        coord = np.append(coord, extension)
 
-        coord = np.nan_to_num(coord)
-        SetListProp(mol, 'coords', coord)
-    return np.array(coord)
+    return np.nan_to_num(coord)
+
+
+# Get coordinates
+def SetCoords(mol):
+    # return the coordinates of the molecule (a row of the coordinate store)
+    # if not stored, calculate first and then add them to the store
+    if mol in coordstore:
+        return coordstore.Row(mol)
+    coord = CalcCoords(mol)
+    # Add can replace the array, so index it afterwards
+    row = coordstore.Add(mol, coord)
+    return coordstore.data[row]
 
 
 # Drive MPI coordinate calculation
@@ -85,13 +149,13 @@ def ScatterCoords(mols):
     if not pl.mpi:
         output.StartTimer('COORDS')
         for mol in mols:
-            if not mol.HasProp('coords'):
+            if mol not in coordstore:
                 SetCoords(mol)
         output.EndTimer('COORDS')
 
         return None
 
-    needCalc = [mol for mol in mols if not mol.HasProp('coords')]
+    needCalc = [mol for mol in mols if mol not in coordstore]
     if len(needCalc) == 0:
         return None
 
@@ -103,10 +167,10 @@ def ScatterCoords(mols):
         myMongo = mongo.LookupDB(metric, needSMI)
         for v, m in zip(myMongo, needCalc):
             if v is not None:
-                SetListProp(m, 'coords', v)
+                coordstore.Add(m, v)
 
         oldn = len(needCalc)
-        needCalc = [mol for mol in mols if not mol.HasProp('coords')]
+        needCalc = [mol for mol in mols if mol not in coordstore]
         print 'Used %d memorized coordinate values' % (oldn - len(needCalc))
 
         if len(needCalc) == 0:
@@ -118,26 +182,45 @@ def ScatterCoords(mols):
     coords = pl.MyTask.RunMPI(needCalc)
 
     for coord, mol in zip(coords, needCalc):
-        SetListProp(mol, 'coords', coord)
+        coordstore.Add(mol, coord)
 
     # Update values in mongo database
     if mprms.UseMongo:
         needSMI = [Chem.MolToSmiles(mol) for mol in needCalc]
         mongo.UpdateDB(
             metric,
-            {s: GetListProp(m, 'coords')
+            {s: list(coordstore.Row(m))
              for s, m in zip(needSMI, needCalc)})
         print '%d new memorized coordinate values' % len(needCalc)
 
     output.EndTimer('COORDS')
 
 
-# Function for scattering coordinate calculations
+# Function for scattering coordinate calculations, the workers return the
+# coordinates and the master stores them
 #@pl.MPIScatter
 def MPICoordCalc(smistring):
     mol = Chem.MolFromSmiles(smistring)
 
-    return SetCoords(mol)
+    return CalcCoords(mol)
+
+
+def GetCoordArray(mols):
+    '''
+    (len(mols), ndim) array with the coordinates of mols, computed first
+    where needed
+    '''
+    ScatterCoords(mols)
+    return coordstore.Coords(mols)
+
+
+def CompactCoords(mols):
+    '''
+    Drop the stored coordinates of molecules that are no longer around,
+    once they take more than half of the coordinate store
+    '''
+    if len(coordstore) > 2 * len(mols):
+        coordstore.Compact(mols)
 
 
 ############################################################
@@ -145,12 +228,18 @@ def MPICoordCalc(smistring):
 ############################################################
 
 
-def GetStdDevs(mols):
+def GetStdDevs(mols, moments=None):
+    '''
+    standard deviations of the coordinates of mols (1 where constant), for
+    molecules from the RunningMoments of the name moments if given
+    '''
+    if moments is not None and type(mols) != np.ndarray:
+        return GetMoments(GetCoordArray(mols), [MolKey(mol) for mol in mols],
+                          moments)[1]
     if type(mols) == np.ndarray:
         coords = mols
     else:
-        ScatterCoords(mols)
-        coords = np.array([SetCoords(mol) for mol in mols])
+        coords = GetCoordArray(mols)
     std_dev = np.std(coords, axis=0)
     for i in xrange(len(std_dev)):
         if abs(std_dev[i]) < 1e-10:
@@ -159,14 +248,179 @@ def GetStdDevs(mols):
     return std_dev
 
 
-def HandleMolCoords(mols, std_dev=None, norm=True, _noDimRed=None):
+class RunningMoments(object):
+    '''
+    Column averages and standard deviations (as GetStdDevs) of the
+    coordinates of a set of molecules that changes from call to call.
+
+    The sums are updated (Welford/Chan) with the molecules that came and
+    went since the last call, the coordinates of those that went are taken
+    from the coordinate store. They are recomputed from scratch when more
+    than half of the set changed, or when the coordinates of molecules
+    that went are no longer stored.
+    '''
+    def __init__(self):
+        self.keys = set()
+        self.n = 0
+        self.avgs = None
+        self.m2 = None
+
+    def Update(self, keys, coords):
+        ''' (averages, std devs) of coords, a row for each of keys '''
+        keyset = set(keys)
+        if len(keyset) < len(keys) or not keys:
+            # duplicates can't be tracked
+            self.avgs = None
+            return np.average(coords, axis=0), GetStdDevs(coords)
+        gone = [key for key in self.keys if key not in keyset]
+        new = [i for i, key in enumerate(keys) if key not in self.keys]
+        if (self.avgs is None or self.avgs.shape != coords.shape[1:] or
+                2 * (len(gone) + len(new)) > len(keys) or
+                any(key not in coordstore.index for key in gone)):
+            self.n = 0
+            self.avgs = np.zeros(coords.shape[1])
+            self.m2 = np.zeros(coords.shape[1])
+            gone = []
+            new = range(len(keys))
+        if gone:
+            self.Combine(coordstore.data[[coordstore.index[key]
+                                          for key in gone]], -1)
+        if new:
+            self.Combine(coords[new], 1)
+        self.keys = keyset
+        std_dev = np.sqrt(np.maximum(self.m2, 0.0) / self.n)
+        std_dev[np.abs(std_dev) < 1e-10] = 1.0
+        return self.avgs.copy(), std_dev
+
+    def Combine(self, coords, sign):
+        ''' add (sign 1) or remove (sign -1) the rows of coords '''
+        nb = len(coords)
+        bavgs = coords.mean(axis=0)
+        bm2 = ((coords - bavgs)**2).sum(axis=0)
+        n = self.n + sign * nb
+        if n == 0:
+            self.avgs[:] = 0.0
+            self.m2[:] = 0.0
+        elif sign > 0:
+            delta = bavgs - self.avgs
+            self.m2 += bm2 + delta**2 * self.n * nb / float(n)
+            self.avgs += delta * nb / float(n)
+        else:
+            # the sums of the rest, from those of all and the removed rows
+            avgs = (self.n * self.avgs - nb * bavgs) / float(n)
+            delta = bavgs - avgs
+            self.m2 -= bm2 + delta**2 * n * nb / float(self.n)
+            self.avgs = avgs
+        self.n = n
+
+
+def GetMoments(coords, keys, name):
+    '''
+    (averages, standard deviations) of coords from the RunningMoments of
+    name, updated for the rows (a key for each). Without keys they are
+    computed directly.
+    '''
+    if keys is None:
+        return np.average(coords, axis=0), GetStdDevs(coords)
+    if name not in _moments:
+        _moments[name] = RunningMoments()
+    return _moments[name].Update(keys, coords)
+
+
+class PCABasis(object):
+    '''
+    PCA basis of the dimRed selection space. An incremental basis is updated
+    with partial fits on the rows it hasn't seen yet (by molecule key, or
+    all rows once per generation if there are no keys). Only the keys of
+    the last set it was fitted on are remembered.
+    '''
+    def __init__(self, ncomp, incremental=False):
+        from sklearn.decomposition import PCA, IncrementalPCA
+        if incremental:
+            self.pca = IncrementalPCA(n_components=ncomp)
+        else:
+            self.pca = PCA(n_components=ncomp)
+        self.incremental = incremental
+        self.gen = None
+        self.seen = set()
+
+    def Fit(self, coords, keys=None):
+        ''' (partial) fit on coords, returns whether the basis changed '''
+        if not self.incremental:
+            self.pca.fit(coords)
+        else:
+            if keys is None:
+                if self.gen == _generation:
+                    return False
+                rows = range(len(coords))
+            else:
+                rows = [i for i, key in enumerate(keys) if key not in self.seen]
+            # a partial fit needs at least as many rows as components, the
+            # rest waits for the next call
+            if len(rows) < self.pca.n_components:
+                return False
+            self.pca.partial_fit(coords[rows])
+            if keys is not None:
+                # molecules that are gone are forgotten, so seen (and the
+                # saved basis) doesn't grow with every molecule of the run
+                self.seen = set(key for key in keys if key in self.seen)
+                self.seen.update(keys[i] for i in rows)
+        self.gen = _generation
+        return True
+
+    def Project(self, coords):
+        return self.pca.transform(coords)
+
+
+def DimRedBasis(coords, keys=None):
+    '''
+    basis to project coords (with the molecule keys of their rows) with,
+    fitted on them as dimRedBasis says. A 'once' or 'every' basis is saved
+    to dimRedFile when it is refit, the others by SaveBasis.
+    '''
+    global _basis
+    if dimRedBasis not in ('refit', 'once', 'every', 'incremental'):
+        raise KeyError('Unknown dimRedBasis: ' + str(dimRedBasis))
+    if (_basis is None or dimRedBasis == 'refit' or
+            (dimRedBasis == 'every' and
+             _generation - _basis.gen >= dimRedRefit)):
+        _basis = PCABasis(dimRed, dimRedBasis == 'incremental')
+    elif dimRedBasis != 'incremental':
+        return _basis
+    if (_basis.Fit(coords, keys) and dimRedBasis in ('once', 'every') and
+            dimRedFile):
+        Enpickle(_basis, dimRedFile)
+    return _basis
+
+
+def SaveBasis(force=False):
+    '''
+    Save a 'refit' or 'incremental' dimRed basis (any basis if force) to
+    dimRedFile. They change on every selection, so they are only saved at
+    the checkpoints.
+    '''
+    if (_basis is not None and dimRedFile and
+            (force or dimRedBasis in ('refit', 'incremental'))):
+        Enpickle(_basis, dimRedFile)
+
+
+def LoadBasis(fname):
+    ''' dimRed basis saved by a previous run '''
+    global _basis
+    _basis = Depickle(fname)
+    return _basis
+
+
+def HandleMolCoords(mols, std_dev=None, norm=True, _noDimRed=None,
+                    moments='pool', keys=None):
     ''' This function handles the coordinate settings
 
     - coordinates are by default normalized
     - coordinates can be reduced in dimensionality this is only done for the selection
       procedure and cannot be used to calculate the aveNNDistance since the PCA covariance 
       matrix differs every generation. Hence the _noDimRed keyword
-    - std_dev can be given or actually calculated
+    - std_dev can be given or actually calculated, from the RunningMoments
+      named moments for molecules (or an array with keys for its rows)
     '''
     #assemble distance vectors
     if type(mols) == np.ndarray:
@@ -174,17 +428,15 @@ def HandleMolCoords(mols, std_dev=None, norm=True, _noDimRed=None):
         passMols = False
     else:
         passMols = True
-        ScatterCoords(mols)
-        coords = np.array([SetCoords(mol) for mol in mols])
+        coords = GetCoordArray(mols)
+        keys = [MolKey(mol) for mol in mols]
 
     # can we do a PCA reduction in the dimension of the coords?
     if dimRed>0 and not _noDimRed:
-        from sklearn.decomposition import PCA
-        pca = PCA(n_components=dimRed)
+        basis = DimRedBasis(coords, keys)
         initial_shape = coords.shape
-        pca.fit(coords)
-        print "\tLeast explained variance:", pca.explained_variance_[-1]
-        coords = pca.transform(coords)
+        print "\tLeast explained variance:", basis.pca.explained_variance_[-1]
+        coords = basis.Project(coords)
         print "\tDimensionality reduction:", initial_shape, "to:", coords.shape
 
     #return coordinates according to normalization or not
@@ -196,16 +448,11 @@ def HandleMolCoords(mols, std_dev=None, norm=True, _noDimRed=None):
                 std_dev = GetStdDevs(std_dev)
 
         #normalize coordinates by their std_dev
+        elif dimRed and not _noDimRed:
+            avgs = np.average(coords, axis=0)
+            std_dev = GetStdDevs(coords)
         else:
-            try:
-                avgs = np.average(coords, axis=0)
-            except TypeError:
-                print coords
-                raise
-            if dimRed and not _noDimRed:
-                std_dev = GetStdDevs(coords)
-            else:
-                std_dev = GetStdDevs(mols)
+            avgs, std_dev = GetMoments(coords, keys, moments)
         coords = (coords - avgs) / std_dev
 
     if extendCoords and extendVariance:
@@ -215,87 +462,267 @@ def HandleMolCoords(mols, std_dev=None, norm=True, _noDimRed=None):
             coords[:, j+i] = coords[:, j+i] * extendVariance[i]
         #coords[:, -1] = coords[:, -1] * extendVariance
 
-    if True:
-        import pickle
-        with open('coords.p', 'wb') as f:
-            pickle.dump(coords, f)
-
     return passMols, coords
 
 
-def Maximin(mols, nMol, firstpick=None, startCoords=None, verbose=False):
+def MaximinPicks(coords, nMol, firstpick=None, startDist=None, seeds=None,
+                 mindists=None, batch=16, nactive=4096, startCoords=None):
+    '''
+    Lazy maximin engine, gives the same picks as recomputing the minimum
+    distances of all candidates after every pick.
+
+    For every candidate we keep a bound: its minimum distance to the picks
+    it has been compared with so far. The minimum distance only decreases,
+    so a stale bound is an upper bound: once the argmax of the bounds is
+    up to date it is the exact next pick (ties go to the lowest index, as
+    before). Until then the candidates with the largest bounds are compared
+    with the newer picks, in batches that double in size. The search is
+    limited to an active set of the nactive largest bounds, which is only
+    rebuilt when all of them have dropped below the rest.
+    Comparisons are skipped when the triangle inequality with the first
+    pick as pivot, |d(j,p0) - d(p,p0)| <= d(j,p), shows that a new pick
+    can't get closer than the bound. Candidates at zero distance can never
+    be picked, they are compacted away once they are half of the arrays.
+
+    The bounds come from the matrix product kernel (distkernel), which
+    rounds differently than cdist. The candidates within its error bound
+    of the best one are therefore brought up to date as well, and the pick
+    is made on their minimum distances from cdist, so near ties and
+    duplicates are resolved exactly as before.
+
+    seeds are picks that are taken as given (the first one is the pivot),
+    the selection continues from there. If mindists is a list, the minimum
+    distance of every new pick at the time it was picked is appended.
+    If startCoords are given as well, startDist are only upper bounds (from
+    an approximate nearest neighbor search). Like the bounds, they are
+    replaced by the exact distances to startCoords when they matter.
+    '''
+    n, ndim = coords.shape
+    if ndim % 2:
+        # cdist sums the squares in pairs, with odd dimensions the result
+        # can depend on the alignment of the rows in memory. Padding to 16
+        # byte rows keeps the distances the same for every array we pass
+        # in, so duplicates stay exact ties.
+        coords = np.hstack([coords, np.zeros((n, 1))])
+        if startCoords is not None:
+            startCoords = np.hstack([startCoords,
+                                     np.zeros((len(startCoords), 1))])
+        ndim += 1
+    points = distkernel.Points(coords)
+    # near ties on the squared bounds
+    tol = 2.0 * distkernel.ErrorBound(points.norms.max(), ndim)
+    start = None
+    # candidates whose start distance is exact
+    startok = np.ones(n, dtype=bool)
+    if startCoords is not None and startDist is not None:
+        startpoints = distkernel.Points(startCoords)
+        startok[:] = False
+
+    def ExactStart(rows):
+        rows = rows[~startok[rows]]
+        if len(rows) > 0:
+            exact = np.sqrt(distkernel.MinSqDists(points[rows], startpoints))
+            start[rows] = exact
+            bound[rows] = np.minimum(bound[rows], exact)
+            startok[rows] = True
+
+    if seeds:
+        bound = np.empty(n)
+        bound.fill(np.inf)
+        picks = [int(i) for i in seeds]
+    elif startDist is not None:
+        bound = np.array(startDist, dtype=float)
+        start = bound.copy()
+        ntop = batch
+        j = np.argmax(bound)
+        while not startok[j]:
+            ExactStart(np.argpartition(-bound, ntop)[:ntop] if ntop < n
+                       else np.arange(n))
+            ntop *= 2
+            j = np.argmax(bound)
+        ExactStart(np.nonzero(bound >= bound[j])[0])
+        picks = [int(np.argmax(bound))]
+    else:
+        if firstpick is None:
+            firstpick = random.randint(0, n - 1)
+        bound = np.empty(n)
+        bound.fill(np.inf)
+        picks = [firstpick]
+    pivot = cdist(coords[picks[0]:picks[0] + 1], coords)[0]
+    np.minimum(bound, pivot, out=bound)
+    bound[picks] = 0.0
+    nseen = np.ones(n, dtype=int)
+    index = np.arange(n)
+
+    # coordinates, squared norms and pivot distances of the picks
+    pickcoords = np.empty((max(nMol, len(picks)), ndim))
+    picknorms = np.empty(len(pickcoords), dtype=points.norms.dtype)
+    pickpivot = np.empty(len(pickcoords))
+    pickcoords[:len(picks)] = coords[picks]
+    picknorms[:len(picks)] = points.norms[picks]
+    pickpivot[:len(picks)] = pivot[picks]
+    state = (bound, nseen, pivot, points, pickcoords, picknorms, pickpivot)
+
+    active = None
+    while len(picks) < nMol:
+        npicks = len(picks)
+        if active is None:
+            # only the candidates with the largest bounds are looked at, the
+            # others stay below the threshold and can't be the next pick
+            # as long as the best active one is above it
+            threshold = 0.0
+            if nactive < len(bound):
+                threshold = np.partition(bound, len(bound) - nactive)[-nactive]
+            active = np.nonzero(bound * bound >= threshold * threshold - tol)[0]
+
+        ntop = batch
+        while True:
+            j = active[np.argmax(bound[active])]
+            while nseen[j] < npicks or not startok[j]:
+                # refresh the active candidates with the largest bounds
+                if ntop < len(active):
+                    top = active[np.argpartition(-bound[active], ntop)[:ntop]]
+                else:
+                    top = active
+                ExactStart(top)
+                RefreshBounds(top, npicks, *state)
+                ntop *= 2
+                j = active[np.argmax(bound[active])]
+            near = active[bound[active]**2 >= bound[j]**2 - tol]
+            stale = near[(nseen[near] < npicks) | ~startok[near]]
+            if len(stale) == 0:
+                break
+            ExactStart(stale)
+            RefreshBounds(stale, npicks, *state)
+        if bound[j] < threshold:
+            active = None
+            continue
+
+        # exact minimum distances of the best candidates
+        exact = cdist(coords[near], pickcoords[:npicks]).min(axis=1)
+        if start is not None:
+            np.minimum(exact, start[near], out=exact)
+        bound[near] = exact
+        k = int(np.argmax(exact))
+        j = near[k]
+        if exact[k] == 0.0:
+            break
+
+        picks.append(int(index[j]))
+        if mindists is not None:
+            mindists.append(float(exact[k]))
+        pickcoords[npicks] = coords[j]
+        picknorms[npicks] = points.norms[j]
+        pickpivot[npicks] = pivot[j]
+        bound[j] = 0.0
+
+        #remove redundant molecules from the arrays
+        if npicks % 64 == 0 and 2 * np.count_nonzero(bound == 0.0) > len(bound):
+            keep = bound > 0.0
+            coords, bound, nseen, pivot, index = (
+                coords[keep], bound[keep], nseen[keep], pivot[keep], index[keep])
+            points, startok = points[keep], startok[keep]
+            if start is not None:
+                start = start[keep]
+            state = (bound, nseen, pivot, points, pickcoords, picknorms,
+                     pickpivot)
+            active = None
+
+    return picks
+
+
+def RefreshBounds(rows, npicks, bound, nseen, pivot, points, pickcoords,
+                  picknorms, pickpivot):
+    '''
+    Update the bounds of the candidates rows with the picks they have not
+    been compared with yet
+    '''
+    rows = rows[nseen[rows] < npicks]
+    if len(rows) == 0:
+        return
+    first = nseen[rows].min()
+    # triangle inequality lower bounds of the distances to the new picks
+    lower = np.abs(pivot[rows][:, None] - pickpivot[None, first:npicks])
+    lower -= 1e-9 * (pivot[rows][:, None] + pickpivot[None, first:npicks])
+    unseen = np.arange(first, npicks)[None, :] >= nseen[rows][:, None]
+    need = np.any(unseen & (lower < bound[rows][:, None]), axis=1)
+    if need.any():
+        update = rows[need]
+        dists = distkernel.SqDists(
+            points.coords[update],
+            distkernel.AsKernelArray(pickcoords[first:npicks]),
+            points.norms[update], picknorms[first:npicks])
+        dists[~unseen[need]] = np.inf
+        bound[update] = np.minimum(bound[update],
+                                   np.sqrt(dists.min(axis=1)))
+    nseen[rows] = npicks
+
+
+def Maximin(mols, nMol, firstpick=None, startCoords=None, verbose=False,
+            warm=None, keys=None):
     '''
     Maximin maximum diversity selection
     mols can be a numpy array containing the coordinates,
     or a list of RDKit molecules
 
-    Use scipy.cdist to handle big array calculations for speed
-    Prunes molecules that have no chance of being selected from 
-    the set every 1000 steps
-    '''
+    The picks come from the lazy greedy engine MaximinPicks, which only
+    computes the distances that can change the next pick. If the minimum
+    distance drops to 0 (duplicates), the rest is picked at random.
 
-    passMols, coords = HandleMolCoords(mols, norm=normCoords)
-    print "coords[0]", coords[0]
-    #if # of mols is smaller than # of mols selected, just keep all of them
+    If mols is a memory mapped coordinate array (MemmapCoords), the
+    selection runs out-of-core, see StreamMaximinPicks.
+
+    With warmStart set, warm names a selection that is repeated every
+    generation (keys identify the rows when mols is an array), and the
+    previous selection is reused as far as it is still valid, see
+    WarmMaximinPicks.
+    '''
     if len(mols) <= nMol:
-        if not passMols:
+        #if # of mols is smaller than # of mols selected, just keep all of them
+        if isinstance(mols, np.ndarray):
             return range(len(mols))
         else:
             return mols
-    #if # of mols is larger
-    minDist = np.array([np.infty] * len(mols))
-    if startCoords is not None:
-        if verbose:
-            print 'Calculating starting distances ...'
-        for i in xrange(0, len(startCoords), 10):
-            minDist = np.minimum(minDist,
-                                 np.min(
-                                     cdist(startCoords[i:i + 10, :], coords),
-                                     axis=0))
-        assert len(minDist) == len(coords)
-        minDist = np.array(minDist)
-        picks = [np.argmax(minDist)]
-    else:
-        if firstpick is None:
-            firstpick = random.randint(0, len(mols) - 1)
-        picks = [firstpick]
 
-    lastcoord = coords[picks[0]:picks[0] + 1]
-    indices = range(coords.shape[0])
-
-    #####################
-    # select the subset #
-    #####################
-    for i in xrange(nMol - 1):
-        dists = cdist(lastcoord, coords)[0]
-        minDist = np.minimum(dists, minDist)
-        nextpick = minDist.argmax()
-        if minDist[nextpick] == 0:
-            break
-        picks.append(indices[nextpick])
-        lastcoord = coords[nextpick:nextpick + 1]
-        #remove redundant molecules from the array
-        if i % 1000 == 0:
-            oldindices = indices
-            oldcoords = coords
-            oldminDist = minDist
-            indices = []
-            coords = []
-            minDist = []
-            for j in xrange(len(oldminDist)):
-                if oldminDist[j] > 0.0:
-                    indices.append(oldindices[j])
-                    coords.append(oldcoords[j])
-                    minDist.append(oldminDist[j])
-            coords = np.array(coords)
-            minDists = np.array(minDist)
+    if isinstance(mols, np.memmap):
+        # out-of-core: the coordinates stay on disk
+        passMols = False
+        picks = StreamMaximinPicks(mols, nMol, firstpick, startCoords)
+    elif warm is not None and warmStart and startCoords is None and not dimRed:
+        passMols, coords = HandleMolCoords(mols, norm=False)
+        if keys is None:
+            keys = [MolKey(mol) for mol in mols]
+        picks = WarmMaximinPicks(coords, keys, nMol, warm, firstpick)
+    else:
+        passMols, coords = HandleMolCoords(mols, norm=normCoords, keys=keys)
+        print "coords[0]", coords[0]
+        startDist = None
+        annCoords = None
+        if startCoords is not None:
             if verbose:
-                print i, len(minDist)
-                sys.stdout.flush()
+                print 'Calculating starting distances ...'
+            if UseANN(len(startCoords), coords.shape[1]):
+                # upper bounds from the approximate neighbors, made exact
+                # by MaximinPicks where needed
+                forest = rpforest.CalibratedForest(startCoords, annRecall)
+                startDist = np.sqrt(forest.Query(coords)[1])
+                annCoords = startCoords
+            else:
+                startDist = np.sqrt(distkernel.MinSqDists(
+                    distkernel.Points(coords), distkernel.Points(startCoords)))
+            assert len(startDist) == len(coords)
+
+        #####################
+        # select the subset #
+        #####################
+        picks = MaximinPicks(coords, nMol, firstpick=firstpick,
+                             startDist=startDist, startCoords=annCoords)
+    if verbose:
+        print 'picked', len(picks), 'of', nMol
 
     #minimum distance went to 0
-    if nMol > 1 and i < nMol - 2:
-        nleft = nMol - 1 - i
+    if len(picks) < nMol:
+        nleft = nMol - len(picks)
         remaining = set(xrange(len(mols))) - set(picks)
         picks = picks + random.sample(remaining, nleft)
 
@@ -305,29 +732,237 @@ def Maximin(mols, nMol, firstpick=None, startCoords=None, verbose=False):
         return picks
 
 
+def MemmapCoords(filename):
+    ''' open a .npy coordinate file memory mapped, for out-of-core Maximin '''
+    return np.load(filename, mmap_mode='r')
+
+
+def SnapshotCoords(mols, gen, final=False):
+    '''
+    Every snapshotInterval generations (and for the final one), write the
+    coordinates of mols to coords<gen>.npy and their isosmi (the key of
+    every row) to coords<gen>.npz. The files are written by a background
+    thread from a copy, the selection goes on meanwhile.
+    '''
+    global _snapshot
+    if not snapshotInterval or (gen % snapshotInterval and not final):
+        return
+    keys = []
+    unique = []
+    seen = set()
+    for mol in mols:
+        key = MolKey(mol)
+        if key not in seen:
+            seen.add(key)
+            keys.append(key)
+            unique.append(mol)
+    coords = GetCoordArray(unique)
+    WaitSnapshot()
+    _snapshot = threading.Thread(target=WriteSnapshot,
+                                 args=('coords{}'.format(gen), coords, keys))
+    _snapshot.start()
+
+
+def WaitSnapshot():
+    ''' wait until the last snapshot is written '''
+    if _snapshot is not None:
+        _snapshot.join()
+
+
+def WriteSnapshot(name, coords, keys):
+    # written under temporary names first, so a snapshot that exists is
+    # complete
+    with open(name + '.npy.tmp', 'wb') as f:
+        np.save(f, coords)
+    with open(name + '.npz.tmp', 'wb') as f:
+        np.savez(f, isosmi=np.array(keys))
+    os.rename(name + '.npy.tmp', name + '.npy')
+    os.rename(name + '.npz.tmp', name + '.npz')
+
+
+def LoadSnapshot(gen):
+    ''' (memory mapped coordinates, isosmi) of the snapshot of gen '''
+    return (MemmapCoords('coords{}.npy'.format(gen)),
+            list(np.load('coords{}.npz'.format(gen))['isosmi']))
+
+
+def StreamMoments(coords):
+    '''
+    column averages and standard deviations (as GetStdDevs) of coords, in
+    one pass over chunks of outOfCoreChunk rows
+    '''
+    n = 0
+    avgs = np.zeros(coords.shape[1])
+    m2 = np.zeros(coords.shape[1])
+    for i in xrange(0, len(coords), outOfCoreChunk):
+        chunk = np.asarray(coords[i:i + outOfCoreChunk], dtype=float)
+        nchunk = len(chunk)
+        chunkavgs = chunk.mean(axis=0)
+        delta = chunkavgs - avgs
+        # combine the sums of squared deviations of both parts
+        m2 += ((chunk - chunkavgs)**2).sum(axis=0) + \
+            delta**2 * n * nchunk / float(n + nchunk)
+        avgs += delta * nchunk / float(n + nchunk)
+        n += nchunk
+    std_dev = np.sqrt(m2 / n)
+    std_dev[np.abs(std_dev) < 1e-10] = 1.0
+    return avgs, std_dev
+
+
+def StreamMaximinPicks(coords, nMol, firstpick=None, startCoords=None,
+                       mindists=None):
+    '''
+    Out-of-core maximin for coordinates that don't fit into memory, e.g. a
+    memory mapped .npy file. Only the minimum distances (8 bytes per
+    molecule) are kept in memory. Every pick streams the coordinates in
+    chunks of outOfCoreChunk rows and normalizes them on the fly like
+    HandleMolCoords (dimRed is not applied). This is the plain greedy
+    algorithm, one pass over the file per pick, so it is bound by the
+    reading speed.
+    startCoords have to be in the normalized space already, as for Maximin.
+    '''
+    n = len(coords)
+    if normCoords:
+        avgs, std_dev = StreamMoments(coords)
+    else:
+        avgs, std_dev = 0.0, 1.0
+
+    def Chunks():
+        for i in xrange(0, n, outOfCoreChunk):
+            chunk = np.asarray(coords[i:i + outOfCoreChunk], dtype=float)
+            yield i, (chunk - avgs) / std_dev
+
+    # squared minimum distances
+    minDist = np.empty(n)
+    minDist.fill(np.inf)
+    if startCoords is not None:
+        start = distkernel.Points(startCoords)
+        for i, chunk in Chunks():
+            minDist[i:i + len(chunk)] = distkernel.MinSqDists(
+                distkernel.Points(chunk), start)
+        firstpick = int(np.argmax(minDist))
+    elif firstpick is None:
+        firstpick = random.randint(0, n - 1)
+
+    picks = [firstpick]
+    while len(picks) < nMol:
+        last = (np.asarray(coords[picks[-1]], dtype=float) - avgs) / std_dev
+        for i, chunk in Chunks():
+            chunk -= last
+            np.minimum(minDist[i:i + len(chunk)],
+                       np.einsum('ij,ij->i', chunk, chunk),
+                       out=minDist[i:i + len(chunk)])
+        nextpick = int(np.argmax(minDist))
+        if minDist[nextpick] == 0.0:
+            break
+        picks.append(nextpick)
+        if mindists is not None:
+            mindists.append(float(np.sqrt(minDist[nextpick])))
+
+    return picks
+
+
+def WarmMaximinPicks(coords, keys, nMol, name, firstpick=None):
+    '''
+    Maximin picks that start from the previous selection of the same name.
+
+    The normalization is frozen at the last cold start (every warmStart
+    selections), so distances between molecules don't change and the
+    previous selection can be replayed: its k-th pick is still the k-th
+    pick as long as it is in the pool and none of the new molecules is
+    further away from the picks before it than it was. Evicted molecules
+    that weren't picked don't matter. Only the new molecules are compared
+    with the replayed picks; from the first pick that changes on, the
+    selection is continued by MaximinPicks with the replayed picks as seeds.
+    '''
+    state = _warmstate.get(name)
+    if state is None or state['age'] >= warmStart:
+        avgs = np.average(coords, axis=0)
+        std_dev = GetStdDevs(coords) if normCoords else np.ones(coords.shape[1])
+        state = {'avgs': avgs, 'std_dev': std_dev, 'age': 0,
+                 'picks': [], 'mindists': [], 'pool': set()}
+        _warmstate[name] = state
+    coords = (coords - state['avgs']) / state['std_dev']
+
+    index = dict((key, i) for i, key in enumerate(keys))
+    new = np.array([i for i, key in enumerate(keys)
+                    if key not in state['pool']], dtype=int)
+    newdist = np.empty(len(new))
+    newdist.fill(np.inf)
+    seeds = []
+    for key, mindist in zip(state['picks'], state['mindists']):
+        if len(seeds) >= nMol or key not in index:
+            break
+        if len(new) > 0 and newdist.max() > mindist:
+            break
+        i = index[key]
+        seeds.append(i)
+        if len(new) > 0:
+            np.minimum(newdist, cdist(coords[i:i + 1], coords[new])[0],
+                       out=newdist)
+    output.Count('WARM MAXIMIN REPLAYED', len(seeds))
+
+    mindists = state['mindists'][:len(seeds)]
+    if len(seeds) == 0:
+        if firstpick is None:
+            firstpick = random.randint(0, len(coords) - 1)
+        seeds = [firstpick]
+        mindists = [np.inf]
+    picks = MaximinPicks(coords, nMol, seeds=seeds, mindists=mindists)
+
+    state['picks'] = [keys[i] for i in picks]
+    state['mindists'] = mindists
+    state['pool'] = set(keys)
+    state['age'] += 1
+    return picks
+
+
+def SphereExclusion(mols, nMol, radius=None):
+    '''
+    Sphere exclusion (leader) selection, a linear time alternative to
+    Maximin. mols can be a numpy array containing the coordinates,
+    or a list of RDKit molecules. See sphereexclusion.py
+    '''
+    from sphereexclusion import SphereExclusionPicks, CalibrateRadius
+
+    passMols, coords = HandleMolCoords(mols, norm=normCoords)
+    if len(mols) <= nMol:
+        if not passMols:
+            return range(len(mols))
+        else:
+            return mols
+
+    distrows = lambda i, idx: cdist(coords[i:i + 1], coords[idx])[0]
+    if radius is None:
+        radius = sphereRadius
+    if radius is None:
+        radius = CalibrateRadius(distrows, len(mols), nMol)
+    print 'Sphere exclusion radius:', radius
+
+    picks = SphereExclusionPicks(distrows, len(mols), nMol, radius)
+    if passMols:
+        return [mols[i] for i in picks]
+    else:
+        return picks
+
+
 def SplitSpace(ids, coords):
     '''
     Split sapce along first PCA coordinate,
     return indices of compounds in the two sets
     '''
-    coords = np.array([coords[i] for i in ids])
-    pcaDecomp = PCA(coords)
+    ids = np.asarray(ids, dtype=int)
+    coords = coords[ids]
+    pcaDecomp = PCA(coords, nVectors=1)
 
-    pc1 = np.real(np.dot(coords, pcaDecomp.evecs[:, 0]))
-    avg = sum(pc1) / len(ids)
-    std_dev = np.sqrt(sum((pc1 - avg)**2) / len(ids))
-
-    iPlus = []
-    iMinus = []
-    iBound = set()
-    for i, pc, coord in zip(xrange(len(pc1)), pc1, coords):
-        if pc > avg:
-            iPlus.append(ids[i])
-        else:
-            iMinus.append(ids[i])
+    pc1 = np.dot(coords, pcaDecomp.evecs[:, 0])
+    avg = np.mean(pc1)
+    std_dev = np.sqrt(np.mean((pc1 - avg)**2))
 
-        if abs(pc - avg) <= 0.1 * std_dev:
-            iBound.add(i)
+    plus = pc1 > avg
+    iPlus = ids[plus].tolist()
+    iMinus = ids[~plus].tolist()
+    iBound = set(ids[np.abs(pc1 - avg) <= 0.1 * std_dev].tolist())
 
     return iPlus, iMinus, iBound
 
@@ -336,29 +971,33 @@ def PCAMaximin(mols, nMol, nsplit=None, verbose=False):
     '''
     Maximin maximum diversity selection -
     Distribute over multiple nodes by splitting the space using PCA
+
+    The regions are run with MPI if it is up, otherwise in a local process
+    pool of nWorkers (or one after the other). Molecules close to a split
+    are picked first, and every region starts from their distances, so
+    picks don't cluster on the boundaries. The picks of all regions are
+    merged by a final maximin that keeps the boundary picks.
     '''
     #need to have at least 2 nodes
     if nsplit is not None:
         numNodes = 2**nsplit
     else:
-        if not pl.mpi:
-            raise NotImplementedError()
-        numNodes = pl.MyTask.size
-        nsplit = int(np.floor(np.log2(numNodes)))
+        numNodes = pl.MyTask.size if pl.mpi else nWorkers
+        nsplit = int(np.floor(np.log2(max(numNodes, 1))))
         numNodes = 2**nsplit
 
     if numNodes < 2:
         print "Using regular maximin instead of PCAmaximin", numNodes, nsplit
         return Maximin(mols, nMol)
 
-    passMols, coords = HandleMolCoords(mols)
-
     if len(mols) <= nMol:
-        if not passMols:
+        if isinstance(mols, np.ndarray):
             return range(len(mols))
         else:
             return mols
 
+    passMols, coords = HandleMolCoords(mols)
+
     ids = [range(len(mols))]
 
     #split molecules along PCA axis
@@ -380,86 +1019,243 @@ def PCAMaximin(mols, nMol, nsplit=None, verbose=False):
 
     #to avoid boundary problems, quickly pick a subset of the things
     #on the boundaries, ensuring that picks will not cluster there
-    boundaryIDs = list(boundaryIDs)
-    cb = np.array([coords[i] for i in boundaryIDs])
+    boundaryIDs = sorted(boundaryIDs)
+    cb = coords[boundaryIDs]
+    nBound = int(nMol * len(boundaryIDs) * 1.0 / len(mols))
 
     if verbose:
         print 'PCA/Maximin: using fast maximin to select compounds on region bound aries.'
-    #b_set = FastMaximin(cb, int(nMol * len(boundaryIDs) * 1.0 / len(mols)))
-    b_set = Maximin(cb, int(nMol * len(boundaryIDs) * 1.0 / len(mols)))
+    # (same space as the regions, no renormalization by Maximin)
+    b_set = MaximinPicks(cb, nBound) if nBound > 0 else []
     pickset = [boundaryIDs[i] for i in b_set]
-    startcoords = np.array([cb[i] for i in b_set])
+    startcoords = cb[b_set]
 
     if verbose:
         print 'PCA/Maximin: selected', len(pickset), 'out of', len(boundaryIDs),\
               'compounds on region boundaries'
 
     #run maximin on each set
-    print 'Scattering PCA-segmented maximin over', numNodes, 'nodes.'
     numToPick = int(1.1 * nMol / numNodes)
-    toSend = [(np.array([coords[i] for i in idn]), numToPick, startcoords)
-              for idn in minDists]
-
-    pl.MyTask.SetFunction(MPI_PCA_Maximin)
-    picks = pl.MyTask.RunMPI(toSend)
-
-    #compile results
-    newpicks = []
-    newmols = []
-    for ids, result in zip(ids, picks):
-        for idx in result:
-            if passMols:
-                newmols.append(mols[ids[idx]])
-            else:
-                newpicks.append(ids[idx])
-    if passMols:
-        newmols += [mols[i] for i in pickset]
+    toSend = [(coords[idn], numToPick, startcoords) for idn in ids]
+    if pl.mpi:
+        print 'Scattering PCA-segmented maximin over', numNodes, 'nodes.'
+        pl.MyTask.SetFunction(MPI_PCA_Maximin)
+        picks = pl.MyTask.RunMPI(toSend)
+    elif nWorkers > 1:
+        print 'PCA-segmented maximin on', min(nWorkers, numNodes), 'processes.'
+        picks = pl.PoolMap(MPI_PCA_Maximin, toSend, min(nWorkers, numNodes))
     else:
-        newpicks += pickset
+        picks = map(MPI_PCA_Maximin, toSend)
+
+    #compile results: the boundary picks first
+    newpicks = list(pickset)
+    inbound = set(pickset)
+    for idn, result in zip(ids, picks):
+        newpicks += [idn[idx] for idx in result if idn[idx] not in inbound]
+
+    #merge the regions, the boundary picks are kept as seeds
+    if len(newpicks) > nMol:
+        merged = MaximinPicks(coords[newpicks], nMol,
+                              seeds=range(len(pickset)) or None)
+        newpicks = [newpicks[i] for i in merged]
+    if len(newpicks) < nMol:
+        remaining = set(xrange(len(mols))) - set(newpicks)
+        newpicks += random.sample(remaining, nMol - len(newpicks))
 
     if passMols:
-        return newmols
+        return [mols[i] for i in newpicks]
     else:
         return newpicks
 
 
 #@pl.MPIScatter
 def MPI_PCA_Maximin(MPISEND):
+    '''
+    maximin picks of one region, starting from the distances to startcoords
+    (coordinates in the same space)
+    '''
     coords, nMol, startcoords = MPISEND
-    picks = Maximin(coords, nMol, startcoords=startcoords)
-    return picks
+    if len(coords) <= nMol:
+        return range(len(coords))
+    startDist = None
+    if len(startcoords) > 0:
+        startDist = np.sqrt(distkernel.MinSqDists(
+            distkernel.Points(coords), distkernel.Points(startcoords)))
+    return MaximinPicks(coords, nMol, startDist=startDist)
+
+
+def UseANN(n, ndim):
+    ''' approximate nearest neighbors for a reference set of n points? '''
+    return annMinSize > 0 and n >= annMinSize and ndim > kdTreeMaxDim
 
 
-def AveNNDistance(mols, getsqrt=False, std_dev=None, norm=True):
+def AveNNDistance(mols, getsqrt=False, std_dev=None, norm=True,
+                  moments='lib'):
     '''
     Calculate diversity function (average nearest-neighbor distance)
     '''
-    passMols, coords = HandleMolCoords(mols, std_dev=std_dev, _noDimRed=True, norm=norm)
+    passMols, coords = HandleMolCoords(mols, std_dev=std_dev, _noDimRed=True,
+                                       norm=norm, moments=moments)
 
     print "in AveNNDistance: coords:", coords.shape
-    N = len(coords)
-    #determine if distance matrix needs to be chunked or not
-    if N > 2000:
-        chunksize = 2000 * 2000 / N
-        nchunk = N / chunksize + 1
+    N, ndim = coords.shape
+    if N >= max(kdTreeMinSize, 2) and ndim <= kdTreeMaxDim:
+        path = 'AVENN KDTREE'
+    elif UseANN(N, ndim):
+        path = 'AVENN RPFOREST'
     else:
-        chunksize = N
-        nchunk = 1
+        path = 'AVENN BRUTE'
+    output.StartTimer(path)
+    if path == 'AVENN KDTREE':
+        from scipy.spatial import cKDTree
+        # k=2: the first neighbor is the point itself (or a duplicate)
+        nearest = cKDTree(coords).query(coords, k=2)[1][:, 1]
+    elif path == 'AVENN RPFOREST':
+        # approximate: a missed neighbor gives a larger distance
+        nearest = rpforest.CalibratedForest(coords, annRecall).SelfQuery()[0]
+    else:
+        # blocked search, see distkernel
+        points = distkernel.Points(coords)
+        nearest = distkernel.Nearest(points, points, offset=0)
+    # the distances are taken from the differences on all paths, so they
+    # give the same value (and don't suffer from the kernel's cancellation)
+    diff = coords - coords[nearest]
+    r2 = np.einsum('ij,ij->i', diff, diff)
+    if getsqrt:
+        nndist = np.sum(np.sqrt(r2))
+    else:
+        nndist = np.sum(r2)
+    output.EndTimer(path)
+
+    return nndist / len(mols)
+
+
+def SampleNNDistance(mols, nSample, getsqrt=False, norm=True):
+    '''
+    Estimate of AveNNDistance from the nearest neighbors (in all of mols)
+    of nSample randomly sampled molecules. Returns the estimate and its
+    standard error.
+    '''
+    passMols, coords = HandleMolCoords(mols, _noDimRed=True, norm=norm,
+                                       moments='lib')
+    N = len(coords)
+    if nSample >= N:
+        return AveNNDistance(coords, getsqrt, norm=False), 0.0
+
+    output.StartTimer('AVENN SAMPLE')
+    sample = np.array(sorted(random.sample(xrange(N), nSample)), dtype=int)
+    points = distkernel.Points(coords)
+    nearest = distkernel.Nearest(points[sample], points, offset=sample)
+    diff = coords[sample] - coords[nearest]
+    r = np.einsum('ij,ij->i', diff, diff)
+    if getsqrt:
+        r = np.sqrt(r)
+    # sampled without replacement: finite population correction
+    stderr = np.std(r, ddof=1) / np.sqrt(nSample) * np.sqrt(
+        (N - nSample) / (N - 1.0))
+    output.EndTimer('AVENN SAMPLE')
+
+    return np.mean(r), stderr
+
+
+def LibraryDiversity(mols, exact=True):
+    '''
+    library diversity (AveNNDistance without normalization) and its
+    standard error, estimated from diversitySample molecules unless exact
+    '''
+    if incrementalNN:
+        global _nntracker
+        if _nntracker is None:
+            _nntracker = NNTracker()
+        return _nntracker.Update(mols), 0.0
+    if exact or not diversitySample or len(mols) <= diversitySample:
+        return AveNNDistance(mols, norm=False), 0.0
+    return SampleNNDistance(mols, diversitySample, norm=False)
+
+
+class NNTracker(object):
+    '''
+    AveNNDistance of a set of molecules that changes a little at a time.
+    The nearest neighbor of every member and the squared distance to it are
+    kept. When the set changes, only members that lost their neighbor and
+    new members are searched against all; the others are only compared
+    with the new members. The coordinates are not normalized with the set,
+    so distances stay valid (norm=False, or a fixed std_dev).
+    '''
+    def __init__(self, std_dev=None):
+        self.std_dev = std_dev
+        self.keys = []
+        self.coords = None
+        self.nearest = np.zeros(0, dtype=int)
+        self.sqdist = np.zeros(0)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def Update(self, mols, getsqrt=False):
+        ''' make the tracked set mols, returns its AveNNDistance '''
+        output.StartTimer('AVENN INCREMENTAL')
+        keys = [MolKey(mol) for mol in mols]
+        keyset = set(keys)
+
+        # members that are gone, and the ones that had them as neighbor
+        keep = np.array([key in keyset for key in self.keys], dtype=bool)
+        if not keep.all():
+            newrow = np.cumsum(keep) - 1
+            lost = ~keep[self.nearest]
+            self.keys = [key for key, k in zip(self.keys, keep) if k]
+            self.coords = self.coords[keep]
+            self.nearest = newrow[self.nearest][keep]
+            self.sqdist = self.sqdist[keep]
+            self.nearest[lost[keep]] = -1
+
+        # new members
+        present = set(self.keys)
+        newmols = []
+        for key, mol in zip(keys, mols):
+            if key not in present:
+                present.add(key)
+                self.keys.append(key)
+                newmols.append(mol)
+        nold = len(self.nearest)
+        if newmols:
+            passMols, newcoords = HandleMolCoords(newmols, norm=False,
+                                                  _noDimRed=True)
+            if self.std_dev is not None:
+                newcoords = newcoords / self.std_dev
+            if self.coords is None:
+                self.coords = newcoords
+            else:
+                self.coords = np.vstack([self.coords, newcoords])
+            self.nearest = np.append(self.nearest, -np.ones(len(newmols), int))
+            self.sqdist = np.append(self.sqdist, np.zeros(len(newmols)))
+
+        points = distkernel.Points(self.coords)
+        redo = np.nonzero(self.nearest < 0)[0]
+        output.Count('NN RECOMPUTED', len(redo))
+        if len(redo) > 0:
+            self.nearest[redo] = distkernel.Nearest(points[redo], points,
+                                                    offset=redo)
+            self.sqdist[redo] = self.SqDist(redo, self.nearest[redo])
+        # the other members only have to look at the new ones
+        old = np.setdiff1d(np.arange(nold), redo)
+        new = np.arange(nold, len(self.keys))
+        if len(old) > 0 and len(new) > 0:
+            cand = new[distkernel.Nearest(points[old], points[new])]
+            sqdist = self.SqDist(old, cand)
+            closer = sqdist < self.sqdist[old]
+            self.nearest[old[closer]] = cand[closer]
+            self.sqdist[old[closer]] = sqdist[closer]
+        output.EndTimer('AVENN INCREMENTAL')
 
-    nndist = 0.0
-    for i in xrange(nchunk):
-        if i * chunksize >= N:
-            break
-        dists = cdist(coords, coords[i * chunksize:(i + 1) * chunksize])
-        for j in xrange(min(chunksize, dists.shape[1])):
-            dists[i * chunksize + j, j] = np.inf
-        r = np.min(dists, axis=0)
         if getsqrt:
-            nndist += sum(r)
-        else:
-            nndist += np.dot(r, r)
+            return np.sum(np.sqrt(self.sqdist)) / len(self.keys)
+        return np.sum(self.sqdist) / len(self.keys)
 
-    return nndist / len(mols)
+    def SqDist(self, rows, nearest):
+        # from the differences, as in AveNNDistance
+        diff = self.coords[rows] - self.coords[nearest]
+        return np.einsum('ij,ij->i', diff, diff)
 
 
 def ScatterAveNNDistance(mols, getsqrt=False):
@@ -494,17 +1290,11 @@ def ScatterAveNNDistance(mols, getsqrt=False):
 #@pl.MPIScatter
 def MPIAveNN(args):
     startchunk, endchunk, chunksize, getsqrt, coords = args
-    nndist = 0.0
-    for i in xrange(startchunk, endchunk):
-        if i * chunksize >= len(coords):
-            break
-        dists = cdist(coords, coords[i * chunksize:(i + 1) * chunksize])
-        for j in xrange(min(chunksize, dists.shape[i])):
-            dists[i * chunksize + j, j] = np.inf
-        r = np.min(dists, axis=0)
-        if getsqrt:
-            nndist += sum(r)
-        else:
-            nndist += np.dot(r, r)
-
-    return nndist
+    points = distkernel.Points(coords)
+    first = min(startchunk * chunksize, len(coords))
+    last = min(endchunk * chunksize, len(coords))
+    r2 = distkernel.MinSqDists(points[first:last], points, offset=first)
+    if getsqrt:
+        return np.sum(np.sqrt(r2))
+    else:
+        return np.sum(r2)
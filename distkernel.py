@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+Euclidean distance kernels built on one matrix product.
+
+Squared distances are computed as |a|^2 + |b|^2 - 2 a.b, with the squared
+row norms computed once and kept with the coordinates (Points). The a.b
+term is a BLAS matrix product, which for 30-200 descriptor dimensions is
+several times faster than cdist's loop over pairs. Large problems are cut
+into tiles of blockBytes, so both sets of points stay in cache and memory
+doesn't grow with the pool size.
+
+The price is rounding: small distances between points far from the origin
+lose digits to cancellation. ErrorBound gives the absolute error of the
+squared distances, for callers (Maximin) that have to resolve near ties
+exactly. With singlePrecision the coordinates are kept in float32, which
+is about twice as fast again but only good to ~1e-7 relative to the norms.
+'''
+import numpy as np
+
+singlePrecision = False  # float32 coordinates
+blockBytes = 1 << 22  # size of one distance tile, roughly the L2/L3 cache
+
+
+def AsKernelArray(coords):
+    ''' contiguous array in the kernel precision (no copy if it already is) '''
+    dtype = np.float32 if singlePrecision else np.float64
+    return np.ascontiguousarray(coords, dtype=dtype)
+
+
+def SqNorms(coords):
+    return np.einsum('ij,ij->i', coords, coords)
+
+
+class Points(object):
+    ''' coordinates in the kernel precision and their squared norms '''
+    def __init__(self, coords, norms=None):
+        self.coords = AsKernelArray(coords)
+        self.norms = SqNorms(self.coords) if norms is None else norms
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, rows):
+        return Points(self.coords[rows], self.norms[rows])
+
+
+def SqDists(a, b, anorms=None, bnorms=None):
+    ''' (len(a), len(b)) array of the squared distances, in one block '''
+    if anorms is None:
+        anorms = SqNorms(a)
+    if bnorms is None:
+        bnorms = SqNorms(b)
+    d = np.dot(a, b.T)
+    d *= -2.0
+    d += anorms[:, None]
+    d += bnorms[None, :]
+    # cancellation can give small negative values
+    np.maximum(d, 0.0, out=d)
+    return d
+
+
+def Dists(a, b, anorms=None, bnorms=None):
+    return np.sqrt(SqDists(a, b, anorms, bnorms))
+
+
+def ErrorBound(maxnorm, ndim, dtype=None):
+    '''
+    bound on the absolute error of the squared distances between points
+    with squared norms up to maxnorm
+    '''
+    if dtype is None:
+        dtype = np.float32 if singlePrecision else np.float64
+    return 8.0 * (ndim + 2) * np.finfo(dtype).eps * maxnorm
+
+
+def TileShape(nrows, ncols, dtype=np.float64):
+    '''
+    rows and columns of a distance tile of about blockBytes, as square as
+    the problem allows, so both sets of points are reused from cache
+    '''
+    size = max(1, blockBytes // np.dtype(dtype).itemsize)
+    rows = max(1, min(nrows, int(np.sqrt(size))))
+    cols = max(1, min(ncols, size // rows))
+    return rows, cols
+
+
+def Tiles(a, b, offset=None):
+    '''
+    (row start, column start, squared distances) for tiles of the distances
+    between a and b (Points), column tiles inner. If a is
+    b[offset:offset + len(a)], or b[offset] for an index array, the
+    distances of the points to themselves are set to inf.
+    '''
+    rows, cols = TileShape(len(a), len(b), a.coords.dtype)
+    if offset is not None:
+        if np.isscalar(offset):
+            offset = offset + np.arange(len(a))
+        offset = np.asarray(offset)
+    for i in xrange(0, len(a), rows):
+        arows = a.coords[i:i + rows]
+        anorms = a.norms[i:i + rows]
+        for j in xrange(0, len(b), cols):
+            d = SqDists(arows, b.coords[j:j + cols], anorms,
+                        b.norms[j:j + cols])
+            if offset is not None:
+                k = np.arange(len(d))
+                diag = offset[i:i + len(d)] - j
+                inside = (diag >= 0) & (diag < d.shape[1])
+                d[k[inside], diag[inside]] = np.inf
+            yield i, j, d
+
+
+def MinSqDists(a, b, offset=None):
+    '''
+    squared distance of every point of a to its nearest point of b (both
+    Points). If a is b[offset:offset + len(a)] (or b[offset] for an index
+    array), the points themselves are skipped.
+    '''
+    mind = np.empty(len(a))
+    mind.fill(np.inf)
+    for i, j, d in Tiles(a, b, offset):
+        np.minimum(mind[i:i + len(d)], d.min(axis=1), out=mind[i:i + len(d)])
+    return mind
+
+
+def Nearest(a, b, offset=None):
+    ''' index of the nearest point of b for every point of a, as MinSqDists '''
+    nearest = np.zeros(len(a), dtype=int)
+    mind = np.empty(len(a))
+    mind.fill(np.inf)
+    for i, j, d in Tiles(a, b, offset):
+        k = d.argmin(axis=1)
+        dk = d[np.arange(len(d)), k]
+        # strictly closer: ties keep the lowest index
+        better = dk < mind[i:i + len(d)]
+        nearest[i:i + len(d)][better] = j + k[better]
+        mind[i:i + len(d)][better] = dk[better]
+    return nearest
+
+
+def DistSums(a, b):
+    ''' sum of the distances of every point of a to all points of b '''
+    sums = np.zeros(len(a))
+    for i, j, d in Tiles(a, b):
+        sums[i:i + len(d)] += np.sqrt(d, out=d).sum(axis=1)
+    return sums
+
+
+def SqDistRow(points, i):
+    ''' squared distances of point i to all points '''
+    return SqDists(points.coords[i:i + 1], points.coords,
+                   points.norms[i:i + 1], points.norms)[0]
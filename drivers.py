@@ -32,6 +32,7 @@ KeepNoGeomPool = True
 
 ##### other variables
 maxPool = 1000
+selection = 'maximin'  # or 'sphereexclusion' (leader picking)
 EdgeLen = 10
 EdgeRatio = 0.1
 
@@ -240,13 +241,21 @@ def ExtendPool(pool, lib, newmol):
 def DriveSelection(pool, subsetSize):
     print "selecting...",
     sys.stdout.flush()
-    #1. select maximin algorithm.
+    #1. select maximin or sphere exclusion algorithm.
+    if selection not in ('maximin', 'sphereexclusion'):
+        raise KeyError('Unknown selection (mprms.selection): ' + str(selection))
     if mprms._similarity:
-        from similarity import FPMaximin
-        lib = FPMaximin(pool, mprms.subsetSize)
+        from similarity import FPMaximin, FPSphereExclusion
+        if selection == 'sphereexclusion':
+            lib = FPSphereExclusion(pool, mprms.subsetSize)
+        else:
+            lib = FPMaximin(pool, mprms.subsetSize)
     else:
-        from distance import Maximin
-        lib = Maximin(pool, mprms.subsetSize)
+        from distance import Maximin, SphereExclusion
+        if selection == 'sphereexclusion':
+            lib = SphereExclusion(pool, mprms.subsetSize)
+        else:
+            lib = Maximin(pool, mprms.subsetSize, warm='selection')
     return lib
 
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+On-disk fingerprint store for large pools.
+
+Fixed length bit vector fingerprints are kept as packed uint64 rows in a
+memory-mapped file (<prefix>.dat). The row index is keyed by isosmi and
+written to <prefix>.idx, so a restarted run can reuse all fingerprints
+computed before. Rows are only ever appended. The header of the index
+holds the signature of the fingerprint (type, parameters, number of
+bits); a store with a different signature is rebuilt.
+'''
+import os
+import numpy as np
+
+from rdkit import Chem
+from rdkit import DataStructs
+
+_popcount8 = np.array([bin(i).count('1') for i in xrange(256)], dtype=np.int32)
+
+
+def PackFP(fp, nwords):
+    ''' pack a bit vector into nwords uint64 words (zero padded) '''
+    row = np.zeros(nwords * 8, dtype=np.uint8)
+    text = np.frombuffer(DataStructs.BitVectToBinaryText(fp), dtype=np.uint8)
+    row[:len(text)] = text
+    return row.view(np.uint64)
+
+
+class FPStore(object):
+    def __init__(self, prefix, signature, nbits, restart=False,
+                 growby=10000):
+        self.datafile = prefix + '.dat'
+        self.indexfile = prefix + '.idx'
+        # fields without spaces, see Signature in similarity
+        self.signature = list(signature)
+        self.growby = growby
+        self.index = {}
+        self.newkeys = []
+        self.nrows = 0
+        self.nbits = nbits
+        self.nwords = (nbits + 63) // 64
+        self.data = None
+        self.counts = np.zeros(0)
+
+        if restart and os.path.isfile(self.indexfile):
+            self.Load()
+        else:
+            for fname in (self.datafile, self.indexfile):
+                if os.path.isfile(fname):
+                    os.remove(fname)
+
+    def __len__(self):
+        return self.nrows
+
+    def Load(self):
+        with open(self.indexfile) as f:
+            header = f.readline().split()
+            keys = [line.rstrip('\n') for line in f]
+        if (header[:1] != ['#FPSTORE'] or header[1:-1] != self.signature or
+                header[-1] != str(self.nwords)):
+            print 'Fingerprint store {} does not match fingerprint {}, rebuilding'.format(
+                self.indexfile, ' '.join(self.signature))
+            for fname in (self.datafile, self.indexfile):
+                if os.path.isfile(fname):
+                    os.remove(fname)
+            return
+        self.nrows = len(keys)
+        self.index = {key: i for i, key in enumerate(keys)}
+        self.OpenData(max(self.nrows, 1))
+        self.counts = self.BitCounts(np.arange(self.nrows))
+        print 'Read {} fingerprints from {}'.format(self.nrows, self.datafile)
+
+    def OpenData(self, nrows):
+        # np.memmap extends the file when opened with a larger shape
+        if self.data is not None:
+            self.data.flush()
+            del self.data
+        mode = 'r+' if os.path.isfile(self.datafile) else 'w+'
+        self.data = np.memmap(self.datafile, dtype=np.uint64, mode=mode,
+                              shape=(nrows, self.nwords))
+        self.capacity = nrows
+
+    def BitCounts(self, rows):
+        rows = np.asarray(rows, dtype=int)
+        if len(rows) == 0:
+            return np.zeros(0)
+        packed = np.asarray(self.data[rows]).view(np.uint8)
+        return _popcount8[packed].sum(axis=1).astype(float)
+
+    def Add(self, key, fp):
+        # zero padding a shorter bit vector is not the RDKit folding
+        if fp.GetNumBits() != self.nbits:
+            raise ValueError('Fingerprint of {} bits does not match the store '
+                             '({})'.format(fp.GetNumBits(),
+                                           ' '.join(self.signature)))
+        if self.data is None or self.nrows >= self.capacity:
+            self.OpenData(self.nrows + self.growby)
+        self.data[self.nrows] = PackFP(fp, self.nwords)
+        self.index[key] = self.nrows
+        self.newkeys.append(key)
+        self.nrows += 1
+        return self.nrows - 1
+
+    def Rows(self, mols, fpcode):
+        ''' row numbers of mols, fingerprints are added to the store if needed '''
+        rows = np.empty(len(mols), dtype=int)
+        for i, mol in enumerate(mols):
+            if mol.HasProp('isosmi'):
+                key = mol.GetProp('isosmi')
+            else:
+                key = Chem.MolToSmiles(mol, True)
+            try:
+                rows[i] = self.index[key]
+            except KeyError:
+                rows[i] = self.Add(key, fpcode(mol))
+        if self.newkeys:
+            self.counts = np.append(
+                self.counts, self.BitCounts(np.arange(len(self.counts), self.nrows)))
+            self.Flush()
+        return rows
+
+    def Packed(self, mols, fpcode):
+        ''' packed fingerprints and bit counts of mols, read from the store '''
+        rows = self.Rows(mols, fpcode)
+        return np.asarray(self.data[rows]), self.counts[rows]
+
+    def Flush(self):
+        if self.data is not None:
+            self.data.flush()
+        if not os.path.isfile(self.indexfile):
+            with open(self.indexfile, 'w') as f:
+                f.write('#FPSTORE {} {}\n'.format(' '.join(self.signature),
+                                                  self.nwords))
+        with open(self.indexfile, 'a') as f:
+            for key in self.newkeys:
+                f.write(key + '\n')
+        self.newkeys = []
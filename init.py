@@ -70,7 +70,10 @@ def Initialize():
     if hasattr(mprms, 'metric') and not mprms.metric in ['', 'similarity']:
         setattr(mprms, '_similarity', False)
         _modules.append('distance')
+        _modules.append('distkernel')
+        _modules.append('rpforest')
         _modules.append('molproperty')
+        _modules.append('pcadimreduction')
     else:
         setattr(mprms, '_similarity', True)
         _modules.append('similarity')
@@ -8,10 +8,7 @@ from rdkit import Chem
 from rdkithelpers import *
 from drivers import RemoveDuplicates
 import output
-
-# fixed global variables
-_array_or = np.vectorize(lambda x, y: x or y)
-_sumhelper = None
+import distkernel
 
 # global variables
 minimize = False  #Minimizing or maximizing the objective function?
@@ -198,24 +195,26 @@ def SelectFittest(newpool, subsetSize, gen):
 
 class NeighborhoodMaximinSelector(object):
     selectfittest=False # False is original method
+    _distcoords = None  # coords of the cached kernel points in GetDistSqr
+    _points = None
     def __init__(self, subsetSize):
         self.subsetSize = subsetSize
         return
 
     @staticmethod
     def GetCoords(pool):
-        distance.ScatterCoords(pool)
-        coords = np.array([GetListProp(mol, 'coords') for mol in pool])
+        coords = distance.GetCoordArray(pool)
         return coords
 
     def GetPureDiversityPicks(self, coords):
-        picks = distance.Maximin(coords, self.subsetSize)
+        picks = distance.Maximin(coords, self.subsetSize, warm='objective',
+                                 keys=self.keys)
         return picks
 
     @staticmethod
     def NormCoords(coords, templib):
         if distance.normCoords:
-            coords = coords / distance.GetStdDevs(templib)
+            coords = coords / distance.GetStdDevs(templib, 'lib')
         return coords
 
     @staticmethod
@@ -226,35 +225,45 @@ class NeighborhoodMaximinSelector(object):
         print 'average diversity value of pure diversity subset:', AveDistSqr
         return AveDistSqr
 
-    @staticmethod
-    def GetDistSqr(coords, ipick):
-        global _sumhelper
-        if _sumhelper is None:
-            _sumhelper = np.ones(len(coords[0]))
-        # 1D difference vector ( positives and negatives )
-        diffvec = coords - coords[ipick]
-        # total sum of squared distances
-        distsqr = np.dot(diffvec * diffvec, _sumhelper)
-        return distsqr
-
-    @staticmethod
-    def GetNeighborPickMask(distsqr, AveDistSqr, pickmask):
-        # get boolean array with False's for every distancevalue greater than 0.75*AveDist 
-        neighbormask = np.ma.getmask(
-            np.ma.masked_greater(distsqr, NeighborhoodFactor * AveDistSqr))
-        # combine maks with the pickmask
-        neighbor_pick_mask = _array_or(neighbormask, pickmask)
-        if debug: print "n masked:", len(neighbormask) - sum(neighbormask),
-        return neighbor_pick_mask
+    def GetDistSqr(self, coords, ipick):
+        # the squared norms are kept for all picks of the same coords
+        if self._distcoords is not coords:
+            self._distcoords = coords
+            self._points = distkernel.Points(coords)
+        return distkernel.SqDistRow(self._points, ipick)
+
+    def GetNeighbors(self, coords, ipick):
+        '''
+        indices and squared distances of the molecules within the
+        neighborhood (NeighborhoodFactor * AveDistSqr) of ipick
+        '''
+        distsqr = self.GetDistSqr(coords, ipick)
+        nbrs = np.nonzero(distsqr <= NeighborhoodFactor * self.AveDistSqr)[0]
+        return nbrs, distsqr[nbrs]
+
+    def GetNeighborhoods(self, coords, picks):
+        '''
+        sparse neighbor lists of the picks, computed once per generation so
+        the main loop only has to look at the neighborhoods
+        '''
+        output.StartTimer('NEIGHBOR LISTS')
+        neighbors = dict((ipick, self.GetNeighbors(coords, ipick))
+                         for ipick in picks)
+        output.EndTimer('NEIGHBOR LISTS')
+        if debug:
+            print 'average neighborhood size:', np.mean(
+                [len(nbrs) for nbrs, d in neighbors.itervalues()])
+        return neighbors
 
     def select(self, pool):
         nSwap = 0
  
         # 2. we assign molecular coordinates to the molecules in pool
         coords = self.GetCoords(pool)
+        self.keys = [mol.GetProp('isosmi') for mol in pool]
  
         # 3. Do some initializations:
-        scores = np.ma.array([mol.GetDoubleProp('Objective') for mol in pool])
+        scores = np.array([mol.GetDoubleProp('Objective') for mol in pool])
  
         # 4 Calculate the diversity measure for the pure diversity subset
         # 4.1 First Select a pure diversity based sample subset
@@ -264,6 +273,7 @@ class NeighborhoodMaximinSelector(object):
         coords = self.NormCoords(coords, templib)
         # 4.3 calculate the average distance
         AveDistSqr = self.GetAveDistSqr(templib)
+        self.AveDistSqr = AveDistSqr
         # 4.4 calculate the average objective value
         aveobj = sum( m.GetDoubleProp('Objective') for m in templib) / (float(len(templib))) 
         print 'Average objective value of pure diversity subset:', aveobj
@@ -272,21 +282,21 @@ class NeighborhoodMaximinSelector(object):
         #Discard the original subset; instead, pick the BEST SCORING COMPOUND
         #within the neighborhood of each compound
  
-        # make a masked array so we don't pick already picked ones 
+        # flag the picked ones so we don't pick them twice
         pickmask = np.zeros(len(pool), dtype=np.bool)
-        for i in picks:
-            pickmask[i] = True
-        # mask every value larger than TargetScore.
-        targetmask = np.ma.getmask(
-            np.ma.masked_greater(scores * minsign, TargetScore * minsign))
+        pickmask[picks] = True
+        # flag every value worse than TargetScore.
+        targetmask = scores * minsign > TargetScore * minsign
         print "targetmask:", targetmask
         print "scores*minsign:", scores * minsign
         print "TargetScore * minsign:", TargetScore * minsign
- 
+
+        neighbors = self.GetNeighborhoods(coords, picks)
+
         output.StartTimer("OBJECTIVE MXMN")
         print 'Optimizing library ...',
         newlib = []
- 
+
         ######### MAIN LOOP #########
         for ipick in picks:
 
@@ -296,47 +306,42 @@ class NeighborhoodMaximinSelector(object):
                 if myscore * minsign <= TargetScore * minsign:
                     newlib.append(pool[ipick])
                     continue
- 
-            #Mask compounds outside of current neighborhood
-            #or that have already been picked
-            distsqr = self.GetDistSqr(coords, ipick)
-            neighbor_pick_mask = self.GetNeighborPickMask(distsqr, AveDistSqr, pickmask)
-
-            mask = _array_or(targetmask, neighbor_pick_mask)
-            if self.selectfittest:
-                distsqr = np.ma.masked_array(scores * -1.0 * minsign, mask=mask)
-            else:
-                 #If any compounds in the neighborhood hit the target, pick
-                 #the closest one
-                 # get dist's of mols not already picked, in neighborhood
-                 # and objective value above cutoff value
-                 distsqr = np.ma.masked_array(distsqr, mask=mask)
-            if distsqr.count() > 0:
-                print "I'm here!"
-                # change pick for best pick:
-                inewpick = np.argmin(distsqr)
+
+            #Only compounds in the current neighborhood
+            #that have not been picked yet
+            nbrs, distsqr = neighbors[ipick]
+            free = ~pickmask[nbrs]
+            nbrs, distsqr = nbrs[free], distsqr[free]
+
+            hit = ~targetmask[nbrs]
+            if hit.any():
+                #If any compounds in the neighborhood hit the target, pick
+                #the closest one (or the fittest one)
+                if self.selectfittest:
+                    inewpick = nbrs[hit][np.argmin(scores[nbrs[hit]] * -1.0 * minsign)]
+                else:
+                    inewpick = nbrs[hit][np.argmin(distsqr[hit])]
                 newlib.append(pool[inewpick])
-                # adjust pickmask
                 pickmask[inewpick] = True
                 pickmask[ipick] = False
                 nSwap += 1
                 continue
- 
+
             #If there is no compound hitting the target, pick the
-            #best one in the neigbhorhood
-            # get only scores in neighborhood not already picked
-            scores.mask = neighbor_pick_mask
-            # and get the best value even if not fullfilling cutoff
-            inewpick = np.argmin(minsign * scores)
-            # if inewpick is different from the current ipick:
-            if scores[inewpick] * minsign < myscore * minsign:
+            #best one in the neigbhorhood even if not fullfilling cutoff
+            inewpick = ipick
+            if len(nbrs) > 0:
+                ibest = nbrs[np.argmin(minsign * scores[nbrs])]
+                if scores[ibest] * minsign < myscore * minsign:
+                    inewpick = ibest
+            if inewpick != ipick:
                 newlib.append(pool[inewpick])
                 pickmask[inewpick] = True
                 pickmask[ipick] = False
                 nSwap += 1
             else:
                 newlib.append(pool[ipick])
- 
+
         #####
         #Done with optimizing maximin
         newlib.sort(
@@ -352,7 +357,13 @@ class NeighborhoodMaximinSelector(object):
 class NeighborhoodMaximinSimilarity(NeighborhoodMaximinSelector):
     @staticmethod
     def GetCoords(pool):
-        sim = similarity.GenFPSimMatrix(pool)
+        # for bit vector fingerprints the similarity rows are computed on
+        # demand, the dense matrix is only built for count fingerprints
+        sim = similarity.GetPackedFPs(pool)
+        if sim is None:
+            sim = similarity.GenFPSimMatrix(pool)
+            # shared with the diversity calculations of this generation
+            similarity.CacheSims(pool, sim)
         return sim
 
     def GetPureDiversityPicks(self, coords):
@@ -373,18 +384,18 @@ class NeighborhoodMaximinSimilarity(NeighborhoodMaximinSelector):
 
     @staticmethod
     def GetDistSqr(coords, ipick):
-        distsqr = (1.0-coords[ipick])**2
-        return distsqr
+        return (1.0-coords[ipick])**2
 
-    @staticmethod
-    def GetNeighborPickMask(distsqr, AveDistSqr, pickmask):
-        # get boolean array with False's for every distancevalue greater than 0.75*AveDist 
-        neighbormask = np.ma.getmask(
-            np.ma.masked_greater(distsqr, NeighborhoodFactor * AveDistSqr))
-        # combine maks with the pickmask
-        neighbor_pick_mask = _array_or(neighbormask, pickmask)
-        if debug: print "n masked:", len(neighbormask) - sum(neighbormask),
-        return neighbor_pick_mask
+    def GetNeighbors(self, coords, ipick):
+        if not isinstance(coords, similarity.PackedFPs):
+            return NeighborhoodMaximinSelector.GetNeighbors(self, coords, ipick)
+        # BitBound: only compare with fingerprints that can be inside the
+        # neighborhood (small slack for the rounding of the square root)
+        maxdistsqr = NeighborhoodFactor * self.AveDistSqr
+        nbrs, sims = coords.Neighbors(ipick, 1.0 - np.sqrt(maxdistsqr) - 1e-9)
+        distsqr = (1.0 - sims)**2
+        inside = distsqr <= maxdistsqr
+        return nbrs[inside], distsqr[inside]
 
 
 class SumSelect(NeighborhoodMaximinSelector):
@@ -399,16 +410,15 @@ class SumSelect(NeighborhoodMaximinSelector):
         self.pdiv = 1.0 - cdiv
 
     def GetDistances(self, coords):
-        from scipy.spatial import distance_matrix
-        Dmatrix = distance_matrix(coords, coords, p=2)
-        Dvector = np.sum(Dmatrix, axis=1)
-        return Dvector
+        points = distkernel.Points(coords)
+        return distkernel.DistSums(points, points)
 
     def select(self, pool):
         nSwap = 0
  
         # 2. we assign molecular coordinates to the molecules in pool
         coords = self.GetCoords(pool)
+        self.keys = [mol.GetProp('isosmi') for mol in pool]
  
         # 3. Do some initializations:
         scores = np.array([mol.GetDoubleProp('Objective') for mol in pool])
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
 
+import os
 import time
 import sys
 import mprms
@@ -17,23 +18,42 @@ statcolumns = ('gen', 'diversity', 'nPool', 'nLib', 'nCand', 'nFilt', 'nDups', '
                'nUnFit', 'nAdd', 'nAddFail', 'nAddArRing', 'nAddArRingFail',
                'nAtomType', 'nAtomTypeFail', 'nBreak', 'nBreakFail', 'nFlip',
                'nFlipFail', 'nNewRing', 'nNewRingFail', 'nRemove',
-               'nRemoveFail', 'nNoMutation')
+               'nRemoveFail', 'nNoMutation', 'diversitySE')
+# columns of the stats file, those of its header on restarts
+_statcolumns = statcolumns
 fitnesscolumns = ('gen', 'NumIn', 'NumOut', 'nSwap', 'AvgFVal', 'MinFVal',
                   'MaxFVal', 'CutOff')
 
 
+def StatColumns(fname):
+    ''' columns in the header of an existing stats file '''
+    with open(fname) as f:
+        header = f.readline()
+        # the header is continued over lines ending with a backslash
+        while header.rstrip().endswith('\\'):
+            header = header.rstrip()[:-1] + f.readline()
+    return header.split()
+
+
 def Init():
-    global statsFile, filterFile, fitnessFile
-    if mprms.restart:
+    global statsFile, filterFile, fitnessFile, _statcolumns
+    _statcolumns = statcolumns
+    if (mprms.restart and os.path.isfile('stats.dat') and
+            os.path.getsize('stats.dat') > 0):
+        # keep the columns of a file written by an older version
+        header = StatColumns('stats.dat')
+        _statcolumns = tuple(key for key in statcolumns if key in header)
         statsFile = open('stats.dat', 'a')
-        filterFile = open('filters.dat', 'a')
     else:
         statsFile = open('stats.dat', 'w')
-        filterFile = open('filters.dat', 'w')
         statsFile.write(" ".join(statcolumns[:7]))
         statsFile.write(" \\\n    ")
         statsFile.write(" ".join(statcolumns[7:]))
         statsFile.write("\n")
+    if mprms.restart:
+        filterFile = open('filters.dat', 'a')
+    else:
+        filterFile = open('filters.dat', 'w')
 
     # objective output
     if mprms.optimize:
@@ -64,7 +84,7 @@ def PrintStat(nColumn=4, flush=True):
         return
     print statsHead
     keys = PrintDict(stats, nColumn, sort='key')
-    for i, key in enumerate(statcolumns):
+    for i, key in enumerate(_statcolumns):
         try:
             statsFile.write(" {:4d} ".format(stats[key]))
         except ValueError:
@@ -94,6 +114,7 @@ def PrintObjectiveStat(nColumn=4, flush=True):
 ##########################
 
 timingHead = "\n\tTIMINGS:"
+counterHead = "\n\tCOUNTERS:"
 totalTimingHead = """\n
 --------------------------------------------------------
                         TOTAL TIMINGS:              
@@ -102,6 +123,8 @@ totalTimingHead = """\n
 timings = {}
 timeRunning = {}
 totalTimes = {}
+counters = defaultdict(_default)
+totalCounters = defaultdict(_default)
 
 
 def StartTimer(key):
@@ -127,6 +150,11 @@ def EndTimer(key):
         timings[key] = runTime
 
 
+def Count(key, n=1):
+    # event counters (cache hits etc.) are reported along with the timings
+    counters[key] += n
+
+
 from functools import wraps
 
 
@@ -147,6 +175,7 @@ def logtime():
 
 def PrintTimings(nColumn=4, flush=True):
     global timings, totalTimes
+    PrintCounters(nColumn, flush)
     keys = timings.keys()
     if len(keys) == 0:
         return
@@ -165,9 +194,22 @@ def PrintTimings(nColumn=4, flush=True):
     '''
 
 
+def PrintCounters(nColumn=4, flush=True):
+    if len(counters) == 0:
+        return
+    print counterHead
+    PrintDict(counters, nColumn, sort='key')
+    if flush:
+        for key, value in counters.iteritems():
+            totalCounters[key] += value
+        counters.clear()
+
+
 def PrintTotalTimings(nColumn=4):
     global totalTimes
     print totalTimingHead
+    if len(totalCounters) > 0:
+        PrintDict(totalCounters, sort='key')
     if len(totalTimes) == 0:
         return
     PrintDict(totalTimes, truncate=True, sort='val')
@@ -3,11 +3,13 @@
 import sys
 import time
 
+import multiprocessing
 import numpy as np
 try:
     from mpi4py import MPI
 except ImportError:
     print "MPI4PY module not loaded"
+    MPI = None
 
 import output
 mpi = False
@@ -21,6 +23,34 @@ in order to make the code in a cleaner way, including:
 #       Functions defined in Parallel.py
 ############################################################
 
+############################################################
+#       Local process pool (no MPI needed)
+############################################################
+
+
+def SharedArray(shape):
+    '''
+    float64 array in shared memory. Workers forked after its creation
+    can write into it, so results don't have to be pickled back.
+    '''
+    raw = multiprocessing.RawArray('d', int(np.prod(shape)))
+    return np.frombuffer(raw, dtype=float).reshape(shape)
+
+
+def PoolMap(func, tasks, nproc):
+    '''
+    Map func over tasks with a local process pool of nproc workers.
+    The pool is forked at every call, so data that func needs can be put
+    in module globals right before calling PoolMap.
+    '''
+    pool = multiprocessing.Pool(nproc)
+    try:
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 ############################################################
 #       Class defined for Parallel Computing (ParallelServer.py)
 ############################################################
@@ -40,7 +70,9 @@ signaldone = [np.array([1], dtype='i'), 'i']
 
 
 class MPITask():
-    def __init__(self, myComm=MPI.COMM_WORLD):
+    def __init__(self, myComm=None):
+        if myComm is None:
+            myComm = MPI.COMM_WORLD
         self.comm = myComm
         self.size = self.comm.Get_size()
         self.rank = self.comm.Get_rank()
@@ -1,11 +1,41 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
+'''
+Principal component analysis of descriptor coordinates.
+
+The full decomposition diagonalizes the covariance matrix with the
+symmetric solver (eigh), or takes the SVD of the data if there are fewer
+points than dimensions. If only the first nVectors components are needed
+(as for the cell grid), a randomized truncated SVD can be used instead
+(randomized): the data is multiplied with nVectors + oversample random
+vectors, refined by powerIter power iterations, and decomposed in that
+subspace only. It is approximate, especially for flat spectra, so it is
+off by default. With normalization the scaling by the standard
+deviations is folded into the products, the data is only centered.
+'''
 from numpy import array, dot, argsort
-from numpy.linalg import eig
+from numpy.linalg import eigh, svd, qr
 import numpy as np
+import random
 
 from rdkit import Chem
 
+oversample = 10
+powerIter = 2
+# randomized truncated SVD: True always, None if it takes fewer operations,
+# False never
+randomized = False
+
+
+def CoordArray(data):
+    ''' numeric coordinates of data (molecules, sequences or an array) '''
+    if isinstance(data, np.ndarray):
+        return data
+    if len(data) > 0 and isinstance(data[0], Chem.Mol):
+        from distance import GetCoordArray
+        return GetCoordArray(data)
+    return np.array(data)
+
 
 # Container to hold PCA results
 class PCADecompose():
@@ -17,7 +47,7 @@ class PCADecompose():
         else:
             self.evecs = evecs
             self.evals = evals
-        self.ndims = len(self.evecs)
+        self.ndims = self.evecs.shape[1]
 
         if std_devs is not None:
             self.norm = True
@@ -31,64 +61,113 @@ class PCADecompose():
     def NormCenter(self, data):
         dp = data - self.means
         if self.norm:
-            dp = dp / self.std_devs
+            dp /= self.std_devs
         return dp
 
     def Project(self, data, ndims=None):
-        if issubclass(type(data), Chem.Mol):
-            coords = array([mol.GetProp('coords') for mol in data])
-            meanpoint = self.NormCenter(coords)
-            return dot(meanpoint, self.evecs[:, :ndims])
-        else:
-            if not issubclass(type(data), np.ndarray):
-                data = np.array(data)
-            if ndims == None:
-                ndims = self.ndims
-            meanpoint = self.NormCenter(data)
-            return dot(meanpoint, self.evecs[:, :ndims])
+        ''' data (a molecule, molecules or coordinates) in the components '''
+        if isinstance(data, Chem.Mol):
+            return self.Project([data], ndims)[0]
+        meanpoint = self.NormCenter(CoordArray(data))
+        return dot(meanpoint, self.evecs[:, :ndims])
+
+
+def RandomizedSVD(X, nVectors, scale=None, seed=None):
+    '''
+    (singular values, right singular vectors) of the first nVectors of X,
+    with its columns multiplied by scale
+    '''
+    if seed is None:
+        # from the run's random state, so runs are reproducible with rseed
+        seed = random.randint(0, 2**31 - 1)
+    rng = np.random.RandomState(seed)
+    nData, nDims = X.shape
+    if scale is None:
+        scale = np.ones(nDims)
+    k = min(nVectors + oversample, nData, nDims)
+    Q = qr(dot(X, scale[:, None] * rng.randn(nDims, k)))[0]
+    for i in xrange(powerIter):
+        # orthonormalized in between, to keep the small components
+        Q = qr(scale[:, None] * dot(X.T, Q))[0]
+        Q = qr(dot(X, scale[:, None] * Q))[0]
+    u, s, vt = svd(dot(Q.T, X) * scale, full_matrices=False)
+    return s[:nVectors], vt[:nVectors].T
+
+
+def UseRandomized(nData, nDims, nVectors):
+    '''
+    randomized SVD if forced, or if allowed (None) and it saves half the
+    operations of the covariance matrix: its 2 * powerIter + 2 products
+    with nVectors + oversample vectors take 2 nData nDims operations per
+    vector, the covariance nData nDims^2
+    '''
+    if nVectors is None or nData < nDims:
+        return False
+    if randomized is not None:
+        return randomized
+    return 4 * (powerIter + 1) * (nVectors + oversample) <= nDims / 2
 
 
 #X is an numpy array where each row is a data point
 #Returns: (loadings, offsets, Projection function) from a PCADecompose object
-def PCA(data, nVectors=None, norm=False):
-    if type(data) is not np.ndarray:
-        try:
-            X = np.array([mol.GetProp('coords') for mol in data])
-        except AttributeError:
-            X = np.array(data)
-    else:
-        X = data
+def PCA(data, nVectors=None, norm=False, seed=None, moments=None):
+    '''
+    PCADecompose of data (molecules or coordinates), with all components
+    or the first nVectors. For molecules the averages and standard
+    deviations can come from the distance.RunningMoments named moments.
+    '''
+    X = CoordArray(data)
     nData, nDims = X.shape
-    means = X.mean(axis=0)
+    std_devs = None
+    if (moments is not None and not isinstance(data, np.ndarray) and
+            nData > 0 and isinstance(data[0], Chem.Mol)):
+        from distance import GetMoments, MolKey
+        means, std_devs = GetMoments(X, [MolKey(mol) for mol in data],
+                                     moments)
+    else:
+        means = X.mean(axis=0)
 
     # center data by mean
     X_ave = X - means
 
-    # normalize data by stddev
-    if norm:
-        std_devs = X.std(axis=0)
-        for i in xrange(len(std_devs)):
-            if abs(std_devs[i]) < 1e-10:
-                std_devs[i] = 1.0
-
-        X_ave = X_ave / std_devs
-
-    # covariance matrix
-    Cov = dot(X_ave.T, X_ave) / (1.0 * nData)
-
-    # diagonalize covariance matrix
-    evals, evecs = eig(Cov)
-
-    # rank eigenvectors, eigenvalues in order
-    sorter = argsort(-evals)
+    if UseRandomized(nData, nDims, nVectors):
+        scale = None
+        if norm:
+            if std_devs is None:
+                std_devs = np.sqrt(np.einsum('ij,ij->j', X_ave, X_ave) /
+                                   nData)
+                std_devs[std_devs < 1e-10] = 1.0
+            scale = 1.0 / std_devs
+        s, evecs = RandomizedSVD(X_ave, nVectors, scale, seed)
+        evals = s**2 / nData
+    elif nData >= nDims:
+        # diagonalize covariance matrix (normalized by the stddevs on its
+        # diagonal), rank eigenvalues in order
+        Cov = dot(X_ave.T, X_ave) / (1.0 * nData)
+        if norm:
+            if std_devs is None:
+                std_devs = np.sqrt(np.diag(Cov))
+                std_devs[std_devs < 1e-10] = 1.0
+            Cov /= np.outer(std_devs, std_devs)
+        evals, evecs = eigh(Cov)
+        sorter = argsort(-evals)
+        evals = np.maximum(evals[sorter], 0.0)
+        evecs = evecs[:, sorter]
+    else:
+        if norm:
+            if std_devs is None:
+                std_devs = X_ave.std(axis=0)
+                std_devs[std_devs < 1e-10] = 1.0
+            X_ave /= std_devs
+        u, s, vt = svd(X_ave, full_matrices=False)
+        evals = s**2 / nData
+        evecs = vt.T
+
+    if nVectors is not None:
+        evals = evals[:nVectors]
+        evecs = evecs[:, :nVectors]
 
     # return a PCADecompose object
     kwargs = {}
     if norm: kwargs['std_devs'] = std_devs
-    try:
-        return PCADecompose(means, evecs[:, sorter], evals[:, sorter], **kwargs)
-    except IndexError:
-        print "evecs.shape, evals.shape:", evecs.shape, evals.shape
-        print "sorter:", sorter
-        return PCADecompose(means, evecs[:, sorter], evals[sorter], **kwargs)
-
+    return PCADecompose(means, evecs, evals, **kwargs)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+Approximate nearest neighbors from a forest of random projection trees.
+
+Every tree splits its points recursively at the median of their
+projection on the line through two random points of the node, down to
+leaves of at most leafSize points. Close points tend to end up in the
+same leaf, so the nearest neighbor of a point is searched only among the
+points that share a leaf with it in one of the trees. Unlike KD-trees
+this doesn't get worse with the number of dimensions, only with the
+intrinsic dimensionality of the data.
+
+More trees give a higher recall (the fraction of points for which the
+exact nearest neighbor is found). CalibratedForest adds trees until the
+recall measured on a sample reaches the requested value. A missed
+neighbor is replaced by one that is further away, so the distances
+returned are upper bounds of the exact ones.
+'''
+import numpy as np
+import random
+
+import distkernel
+
+leafSize = 256
+maxTrees = 64
+
+
+class RPTree(object):
+    def __init__(self, coords, leafSize, rng):
+        # internal nodes: projection direction, split value, children
+        # (leaves are stored as ~index into self.leaves)
+        self.dirs = []
+        self.splits = []
+        self.children = []
+        self.leaves = []
+        self.Build(coords, np.arange(len(coords)), leafSize, rng)
+
+    def Build(self, coords, rows, leafSize, rng):
+        if len(rows) <= leafSize:
+            self.leaves.append(rows)
+            return ~(len(self.leaves) - 1)
+        a, b = rows[rng.randint(len(rows), size=2)]
+        direction = coords[a] - coords[b]
+        if not direction.any():
+            direction = rng.randn(coords.shape[1])
+        proj = np.dot(coords[rows], direction)
+        split = np.median(proj)
+        left = proj < split
+        if left.all() or not left.any():
+            # all projections equal (duplicates): split in two halves
+            left = np.zeros(len(rows), dtype=bool)
+            left[rng.permutation(len(rows))[:len(rows) // 2]] = True
+        node = len(self.dirs)
+        self.dirs.append(direction)
+        self.splits.append(split)
+        self.children.append([None, None])
+        self.children[node][0] = self.Build(coords, rows[left], leafSize, rng)
+        self.children[node][1] = self.Build(coords, rows[~left], leafSize, rng)
+        return node
+
+    def Leaves(self, coords):
+        ''' leaf of every point of coords '''
+        leaf = np.empty(len(coords), dtype=int)
+        stack = [(0 if self.dirs else ~0, np.arange(len(coords)))]
+        while stack:
+            node, rows = stack.pop()
+            if node < 0:
+                leaf[rows] = ~node
+                continue
+            left = np.dot(coords[rows], self.dirs[node]) < self.splits[node]
+            stack.append((self.children[node][0], rows[left]))
+            stack.append((self.children[node][1], rows[~left]))
+        return leaf
+
+
+class RPForest(object):
+    '''
+    Forest of random projection trees over coords. Query gives the
+    approximate nearest neighbors of other points, SelfQuery those of the
+    indexed points themselves.
+    '''
+    def __init__(self, coords, leaf=None, seed=None):
+        self.points = distkernel.Points(coords)
+        self.leafSize = leaf or leafSize
+        if seed is None:
+            # from the run's random state, so runs are reproducible with rseed
+            seed = random.randint(0, 2**31 - 1)
+        self.rng = np.random.RandomState(seed)
+        self.trees = []
+        # nearest neighbors of the indexed points, updated for every tree
+        self.nearest = np.zeros(len(self.points), dtype=int)
+        self.sqdist = np.empty(len(self.points))
+        self.sqdist.fill(np.inf)
+
+    def __len__(self):
+        return len(self.trees)
+
+    def AddTrees(self, n=1):
+        for i in xrange(n):
+            tree = RPTree(self.points.coords, self.leafSize, self.rng)
+            self.trees.append(tree)
+            for rows in tree.leaves:
+                d = distkernel.SqDists(self.points.coords[rows],
+                                       self.points.coords[rows],
+                                       self.points.norms[rows],
+                                       self.points.norms[rows])
+                np.fill_diagonal(d, np.inf)
+                self.Update(self.nearest, self.sqdist, rows, rows, d)
+
+    @staticmethod
+    def Update(nearest, sqdist, rows, cols, d):
+        k = d.argmin(axis=1)
+        dk = d[np.arange(len(rows)), k]
+        better = dk < sqdist[rows]
+        nearest[rows[better]] = cols[k[better]]
+        sqdist[rows[better]] = dk[better]
+
+    def SelfQuery(self):
+        ''' (nearest, squared distance) of the indexed points, self excluded '''
+        return self.nearest, self.sqdist
+
+    def Query(self, coords):
+        ''' (nearest, squared distance) in the index for the points coords '''
+        query = distkernel.Points(coords)
+        nearest = np.zeros(len(query), dtype=int)
+        sqdist = np.empty(len(query))
+        sqdist.fill(np.inf)
+        for tree in self.trees:
+            leaf = tree.Leaves(query.coords)
+            order = np.argsort(leaf, kind='mergesort')
+            bounds = np.nonzero(np.diff(leaf[order]))[0] + 1
+            for rows in np.split(order, bounds):
+                if len(rows) == 0:
+                    continue
+                cols = tree.leaves[leaf[rows[0]]]
+                d = distkernel.SqDists(query.coords[rows],
+                                       self.points.coords[cols],
+                                       query.norms[rows],
+                                       self.points.norms[cols])
+                self.Update(nearest, sqdist, rows, cols, d)
+        return nearest, sqdist
+
+
+def SelfRecall(forest, sample, exact):
+    ''' fraction of sample whose exact nearest neighbor distance was found '''
+    points = forest.points
+    tol = distkernel.ErrorBound(points.norms.max(), points.coords.shape[1])
+    return np.mean(forest.sqdist[sample] <= exact + tol)
+
+
+def CalibratedForest(coords, recall, nSample=256, seed=None):
+    '''
+    Forest with trees added until the recall on a sample of nSample points
+    reaches recall (or maxTrees)
+    '''
+    forest = RPForest(coords, seed=seed)
+    n = len(forest.points)
+    sample = forest.rng.choice(n, min(nSample, n), replace=False)
+    d = distkernel.SqDists(forest.points.coords[sample], forest.points.coords,
+                           forest.points.norms[sample], forest.points.norms)
+    d[np.arange(len(sample)), sample] = np.inf
+    exact = d.min(axis=1)
+    forest.AddTrees(2)
+    while len(forest) < maxTrees and SelfRecall(forest, sample,
+                                                exact) < recall:
+        forest.AddTrees(1)
+    return forest
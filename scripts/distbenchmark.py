@@ -0,0 +1,175 @@
+#/usr/bin/env python
+'''
+Benchmark of the coordinate based selection routines on synthetic
+descriptor coordinates (gaussian clusters).
+usage: python distbenchmark.py [ndims]
+'''
+import sys
+import time
+import random
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from ACSESS import distance, distkernel, rpforest, pcadimreduction
+
+ndims = 30
+poolsizes = [1000, 5000, 20000, 100000]
+nPick = 100
+nCluster = 20
+kerneldims = [30, 50, 100, 200]
+kernelsize = 4000
+nsplit = 2  # PCAMaximin regions: 2**nsplit
+anndims = [42, 192]  # MQN, autocorr2D
+annsizes = [5000, 20000]
+annrecalls = [0.9, 0.99]
+pcasizes = [(100000, 200), (20000, 1000)]  # (n, ndims)
+pcaVectors = 3  # nCellDims
+
+if len(sys.argv) > 1: ndims = int(sys.argv[1])
+distance.normCoords = False
+random.seed(42)
+np.random.seed(42)
+
+
+def MakeCoords(n, ndims):
+    centers = 5.0 * np.random.randn(nCluster, ndims)
+    return centers[np.random.randint(nCluster, size=n)] + np.random.randn(n, ndims)
+
+
+def timeit(f, *args):
+    t0 = time.time()
+    r = f(*args)
+    return time.time() - t0, r
+
+
+def MinDist(coords):
+    dists = cdist(coords, coords)
+    np.fill_diagonal(dists, np.inf)
+    return dists.min()
+
+
+############################################
+## 1. maximin vs. sphere exclusion        ##
+############################################
+print "\n## selection of {} points in {} dimensions: ave. NN distance^2 / " \
+      "min. distance of the subset and wall time".format(nPick, ndims)
+print "{:>8} {:>18} {:>10} {:>18} {:>10}".format(
+    'n', 'maximin', 't', 'sphereexcl', 't')
+for n in poolsizes:
+    coords = MakeCoords(n, ndims)
+    tmxmn, mxmn = timeit(distance.Maximin, coords, nPick)
+    tse, se = timeit(distance.SphereExclusion, coords, nPick)
+    print "{:8d} {:9.3f} {:8.3f} {:10.3f} {:9.3f} {:8.3f} {:10.3f}".format(
+        n, distance.AveNNDistance(coords[mxmn], norm=False), MinDist(coords[mxmn]), tmxmn,
+        distance.AveNNDistance(coords[se], norm=False), MinDist(coords[se]), tse)
+
+
+############################################
+## 2. distance kernels vs. cdist          ##
+############################################
+# full distance matrix between two sets of kernelsize points: cdist and
+# the matrix product kernel in double and single precision (including the
+# norms and conversions), max. error relative to the largest distance
+print "\n## {0}x{0} distance matrix: wall time and max. relative " \
+      "error".format(kernelsize)
+print "{:>6} {:>10} {:>10} {:>10} {:>12} {:>12}".format(
+    'ndims', 'cdist', 'float64', 'float32', 'err64', 'err32')
+for nd in kerneldims:
+    a = MakeCoords(kernelsize, nd)
+    b = MakeCoords(kernelsize, nd)
+    tcd, exact = timeit(cdist, a, b)
+    result = []
+    for single in (False, True):
+        distkernel.singlePrecision = single
+        t, d = timeit(lambda: distkernel.Dists(
+            distkernel.AsKernelArray(a), distkernel.AsKernelArray(b)))
+        result += [t, np.abs(d - exact).max() / exact.max()]
+    distkernel.singlePrecision = False
+    print "{:6d} {:10.3f} {:10.3f} {:10.3f} {:12.2e} {:12.2e}".format(
+        nd, tcd, result[0], result[2], result[1], result[3])
+
+
+############################################
+## 3. PCA-split maximin vs. maximin       ##
+############################################
+# regions run in a local process pool of 2**nsplit workers
+distance.nWorkers = 2**nsplit
+print "\n## selection of {} points, PCAMaximin with {} regions: ave. NN " \
+      "distance^2 / min. distance and wall time".format(nPick, 2**nsplit)
+print "{:>8} {:>18} {:>10} {:>18} {:>10}".format(
+    'n', 'maximin', 't', 'pcamaximin', 't')
+for n in poolsizes:
+    coords = MakeCoords(n, ndims)
+    tmxmn, mxmn = timeit(distance.Maximin, coords, nPick)
+    tpca, pca = timeit(distance.PCAMaximin, coords, nPick, nsplit)
+    print "{:8d} {:9.3f} {:8.3f} {:10.3f} {:9.3f} {:8.3f} {:10.3f}".format(
+        n, distance.AveNNDistance(coords[mxmn], norm=False), MinDist(coords[mxmn]), tmxmn,
+        distance.AveNNDistance(coords[pca], norm=False), MinDist(coords[pca]), tpca)
+
+
+############################################
+## 4. random projection forest ANN        ##
+############################################
+# nearest neighbor of every point: brute force against the forest
+# calibrated for the target recall; measured recall (exact NN distance
+# found) and ratio of the ave. NN distance^2 to the exact one
+print "\n## approximate nearest neighbors: wall time, measured recall"
+print "{:>8} {:>6} {:>7} {:>6} {:>10} {:>10} {:>8} {:>10}".format(
+    'n', 'ndims', 'target', 'trees', 'brute', 'forest', 'recall', 'avenn')
+for n in annsizes:
+    for nd in anndims:
+        coords = MakeCoords(n, nd)
+        points = distkernel.Points(coords)
+        tbrute, nearest = timeit(distkernel.Nearest, points, points, 0)
+        exact = ((coords - coords[nearest])**2).sum(axis=1)
+        for recall in annrecalls:
+            tann, forest = timeit(rpforest.CalibratedForest, coords, recall)
+            approx = forest.SelfQuery()[0]
+            approx = ((coords - coords[approx])**2).sum(axis=1)
+            print "{:8d} {:6d} {:7.2f} {:6d} {:10.3f} {:10.3f} {:8.3f} " \
+                  "{:10.4f}".format(n, nd, recall, len(forest), tbrute, tann,
+                                    np.mean(approx <= exact * (1 + 1e-9)),
+                                    approx.sum() / exact.sum())
+
+
+
+############################################
+## 5. PCA: eig, eigh, randomized          ##
+############################################
+# normalized PCA as for the cell grid: the old general eig of the
+# covariance, the full symmetric one, the truncated one for the first
+# pcaVectors components with randomized = None (randomized only where it
+# saves operations) and the randomized one forced; max. relative error of the first eigenvalues
+# and fraction of their variance captured by the components
+print "\n## PCA, first {} components: wall time and errors".format(pcaVectors)
+print "{:>8} {:>6} {:>10} {:>10} {:>12} {:>10}".format(
+    'n', 'ndims', 'method', 't', 'err evals', 'variance')
+
+
+def EigPCA(X):
+    X = (X - X.mean(axis=0)) / X.std(axis=0)
+    evals, evecs = np.linalg.eig(np.dot(X.T, X) / len(X))
+    sorter = np.argsort(-evals)
+    return pcadimreduction.PCADecompose(0.0, evecs[:, sorter],
+                                        evals[sorter])
+
+
+for n, nd in pcasizes:
+    coords = MakeCoords(n, nd)
+    normed = (coords - coords.mean(axis=0)) / coords.std(axis=0)
+    texact, exact = timeit(pcadimreduction.PCA, coords, None, True)
+    evals = exact.evals[:pcaVectors]
+    for name in ('eig', 'eigh', 'truncated', 'randomized'):
+        if name == 'eig':
+            t, decomp = timeit(EigPCA, coords)
+        elif name == 'eigh':
+            t, decomp = texact, exact
+        else:
+            pcadimreduction.randomized = (name == 'randomized') or None
+            t, decomp = timeit(pcadimreduction.PCA, coords, pcaVectors, True)
+            pcadimreduction.randomized = False
+        evecs = decomp.evecs[:, :pcaVectors]
+        err = np.abs(decomp.evals[:pcaVectors] / evals - 1).max()
+        var = (np.dot(normed, evecs)**2).sum() / n / evals.sum()
+        print "{:8d} {:6d} {:>10} {:10.3f} {:12.2e} {:10.6f}".format(
+            n, nd, name, t, err, var)
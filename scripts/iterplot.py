@@ -5,7 +5,6 @@ import os
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
-from sklearn.decomposition import PCA
 
 from ACSESS import distance
 # initiate distance
@@ -15,6 +14,13 @@ n_components=3
 
 distance.Init()
 
+# project every generation on the same basis: the one saved by the run if
+# there is one, else the one fitted on the first file
+distance.dimRedBasis = 'once'
+if os.path.isfile(distance.dimRedFile):
+    distance.LoadBasis(distance.dimRedFile)
+distance.dimRedFile = None  # don't overwrite the basis of the run
+
 def set_nxy(n):
     xys = { '1':(1,1), '2':(2,1), '3':(1,3), '4':(2,2), '5':(3,2), 
             '6':(3,2), '7':(4,2), '8':(4,2), '9':(3,3), '10':(4,3)
@@ -23,7 +29,7 @@ def set_nxy(n):
 
 def pcaplot3d(coords, gen):
     ax = fig.add_subplot(nx, ny, i+1, projection='3d')
-    X_reduced = PCA(n_components=n_components).fit_transform(coords)
+    X_reduced = coords[:, :n_components]
     ax.scatter(X_reduced[:, 0], X_reduced[:, 1], X_reduced[:, 2],
     #                  c=y,
                        cmap=plt.cm.Set1, edgecolor='k', s=40)
@@ -38,7 +44,7 @@ def pcaplot3d(coords, gen):
 
 def pcaplot2d(coords, gen):
     ax = fig.add_subplot(nx, ny, i+1)
-    X_reduced = PCA(n_components=n_components).fit_transform(coords)
+    X_reduced = coords[:, :n_components]
     ax.scatter(X_reduced[:, 0], X_reduced[:, 1],
     #                  c=y,
                        cmap=plt.cm.Set1)
@@ -82,7 +88,9 @@ for i, (gen, iterf) in enumerate(iterfiles):
 
 
     # set coords
-    passmols, coords = distance.HandleMolCoords(lib, _noDimRed=False)
+    # unnormalized, so the generations stay comparable
+    passmols, coords = distance.HandleMolCoords(lib, norm=False,
+                                                _noDimRed=False)
     print coords[1], type(coords[1]), coords[1].shape
 
     # do a PCA plot
@@ -0,0 +1,102 @@
+#/usr/bin/env python
+'''
+Benchmark of the similarity routines on pools of increasing size.
+usage: python simbenchmark.py [smilesfile] [fp] [measure]
+
+pools larger than the smiles file are sampled with replacement, which
+doesn't matter for the timings.
+'''
+import sys
+import time
+import random
+import numpy as np
+from rdkit import Chem
+
+from ACSESS import similarity
+
+smifile = 'pool.smi'
+poolsizes = [250, 500, 1000, 2000, 5000]
+loopmax = 2000  # the pure python loop gets too slow beyond this
+
+if len(sys.argv) > 1: smifile = sys.argv[1]
+if len(sys.argv) > 2: similarity.fp = sys.argv[2]
+if len(sys.argv) > 3: similarity.measure = sys.argv[3]
+similarity.Init()
+random.seed(42)
+
+supplier = Chem.SmilesMolSupplier(smifile, titleLine=False)
+mols = [mol for mol in supplier if mol is not None]
+print "{} molecules read from {}".format(len(mols), smifile)
+
+
+def timeit(f, *args):
+    t0 = time.time()
+    r = f(*args)
+    return time.time() - t0, r
+
+
+######################################
+## 1. GenFPSimMatrix kernels        ##
+######################################
+print "\n## similarity matrix:", similarity.fp, similarity.measure
+print "{:>8} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+    'n', 'fpdb', 'loop', 'bulk', 'numpy', 'max|diff|')
+for n in poolsizes:
+    pool = [random.choice(mols) for i in xrange(n)]
+    tfp, fps = timeit(similarity.FPDB, pool, similarity.fpcode)
+    tbulk, sbulk = timeit(similarity.FPSimMatrix, fps, 'bulk')
+    if n <= loopmax:
+        tloop, sloop = timeit(similarity.FPSimMatrix, fps, 'loop')
+        diff = np.abs(sloop - sbulk).max()
+    else:
+        tloop, diff = np.nan, np.nan
+    if similarity.IsBitVect(fps):
+        tnp, snp = timeit(similarity.FPSimMatrix, fps, 'numpy')
+        diff = np.nanmax([diff, np.abs(snp - sbulk).max()])
+    else:
+        tnp = np.nan
+    print "{:8d} {:10.3f} {:10.3f} {:10.3f} {:10.3f} {:12.2e}".format(
+        n, tfp, tloop, tbulk, tnp, diff)
+
+
+######################################
+## 2. maximin vs. sphere exclusion  ##
+######################################
+nPick = 100
+print "\n## selection of {} molecules: NN similarity of the subset " \
+      "(lower is more diverse) and wall time".format(nPick)
+print "{:>8} {:>12} {:>10} {:>12} {:>10}".format(
+    'n', 'maximin', 't', 'sphereexcl', 't')
+for n in poolsizes:
+    pool = [random.choice(mols) for i in xrange(n)]
+    tmxmn, mxmn = timeit(similarity.FPMaximin, pool, nPick)
+    tse, se = timeit(similarity.FPSphereExclusion, pool, nPick)
+    print "{:8d} {:12.4f} {:10.3f} {:12.4f} {:10.3f}".format(
+        n, similarity.NNSimilarity(mxmn), tmxmn,
+        similarity.NNSimilarity(se), tse)
+
+
+######################################
+## 3. folded atom pair counts       ##
+######################################
+# folding loss: similarities of the folded fingerprints against the sparse
+# atom pair counts, and how often the nearest neighbor stays the same
+foldings = [(1024, 1), (2048, 1), (1024, 4), (2048, 4)]
+# (sampled without replacement, duplicates would make the NN ambiguous)
+pool = random.sample(mols, min(1000, len(mols)))
+n = len(pool)
+apcode = similarity.fpcodes['atompairs']
+tcount, counts = timeit(similarity.FPDB, pool, apcode)
+texact, exact = timeit(similarity.FPSimMatrix, counts, 'bulk')
+print "\n## folded atom pairs, n={}: sparse counts {:.3f} s " \
+      "(fps {:.3f} s)".format(n, texact, tcount)
+print "{:>6} {:>6} {:>10} {:>10} {:>12} {:>12} {:>8}".format(
+    'slots', 'levels', 'fold', 'numpy', 'mean|diff|', 'max|diff|', 'sameNN')
+for nslots, levels in foldings:
+    tfold, folded = timeit(
+        lambda: [similarity.FoldCountFP(f, nslots, levels) for f in counts])
+    tnp, sim = timeit(similarity.FPSimMatrix, folded, 'numpy')
+    diff = np.abs(sim - exact)
+    samenn = np.mean(np.argmax(sim, axis=1) == np.argmax(exact, axis=1))
+    print "{:6d} {:6d} {:10.3f} {:10.3f} {:12.2e} {:12.2e} {:8.3f}".format(
+        nslots, levels, tfold, tnp, diff.mean(), diff.max(), samenn)
@@ -2,6 +2,7 @@
 #-*- coding: utf-8 -*-
 import numpy as np
 import random
+from collections import OrderedDict
 
 from rdkit import Chem
 from rdkit.Chem import AllChem
@@ -9,6 +10,14 @@ from rdkit import DataStructs
 from rdkit.Chem.Fingerprints import FingerprintMols
 
 from rdkit.Chem import MACCSkeys
+try:
+    from rdkit.Chem import rdFingerprintGenerator
+except ImportError:
+    # older RDKit versions (<2018.09) have no fingerprint generators
+    rdFingerprintGenerator = None
+
+import mprms
+import output
 
 # Global variables
 fp = 'rdkit'
@@ -16,6 +25,9 @@ measure = 'tanimoto'
 morganradius = 2
 dmetric = None
 fpcode= None
+fpCacheMB = 256  # memory cap of the fingerprint cache, 0 switches it off
+fpStore = ''  # file prefix of the memory-mapped fingerprint store, '' is off
+store = None
 
 # old OE codes:
 #fpcodes={'lingo':OEFPType_Lingo,
@@ -35,6 +47,52 @@ dmetrics = {'tanimoto': DataStructs.TanimotoSimilarity,  # a, b = 1, 1
            'tversky': lambda m1, m2: DataStructs.TverskySimilarity(m1, m2, 0.5, 0.5),
            'sokal': DataStructs.SokalSimilarity }
 
+# one fingerprint against a list of fingerprints in a single call
+bulkmetrics = {'tanimoto': DataStructs.BulkTanimotoSimilarity,
+               'dice': DataStructs.BulkDiceSimilarity,
+               'cosine': DataStructs.BulkCosineSimilarity,
+               'tversky': lambda fp, fps: DataStructs.BulkTverskySimilarity(fp, fps, 0.5, 0.5),
+               'sokal': DataStructs.BulkSokalSimilarity }
+
+# the same measures in terms of bit counts: c=|A&B|, a=|A|, b=|B|
+countmetrics = {'tanimoto': lambda c, a, b: c / (a + b - c),
+                'dice': lambda c, a, b: 2.0 * c / (a + b),
+                'cosine': lambda c, a, b: c / np.sqrt(a * b),
+                'tversky': lambda c, a, b: c / (0.5 * (a - c) + 0.5 * (b - c) + c),
+                'sokal': lambda c, a, b: c / (2.0 * a + 2.0 * b - 3.0 * c) }
+
+# similarity matrix kernel: 'bulk' (RDKit Bulk*Similarity row by row),
+# 'numpy' (packed bit matrix, only for bit vector fingerprints) or 'loop'
+simkernel = 'bulk'
+simBlockSize = 1000
+# local worker processes for the similarity matrix (no MPI needed)
+nWorkers = 1
+# libraries larger than this get their NN similarity from a sparse
+# neighbor graph built in row blocks instead of the dense matrix (0: never)
+sparseNNSize = 5000
+# nearest neighbor searches on bit vectors skip candidates by their bit counts
+bitBoundNN = True
+# sphere exclusion radius as a distance (1 - similarity), None: calibrated
+sphereRadius = None
+# fold count fingerprints (atompairs) into foldCounts slots of a bit vector,
+# so they run through the bit vector engine (0 keeps the sparse counts).
+# Each slot gets foldLevels bits: the count is stored in unary, capped at
+# foldLevels, which makes |A&B| the sum of the minimum counts.
+foldCounts = 0
+foldLevels = 1
+bulkmetric = None
+countmetric = None
+_popcount8 = np.array([bin(i).count('1') for i in xrange(256)], dtype=np.int32)
+
+# fingerprint cache: isosmi -> (fingerprint, approximate size in bytes)
+_fpcache = OrderedDict()
+_fpcachesize = 0
+# data inherited by the forked similarity matrix workers
+_worker = {}
+# similarities computed during the current generation: isosmi -> index
+# into the square matrix of the molecules they were computed for
+_simcache = {'index': {}, 'matrix': None}
+
 #########################
 # Module initialization #
 #########################
@@ -42,7 +100,7 @@ dmetrics = {'tanimoto': DataStructs.TanimotoSimilarity,  # a, b = 1, 1
 
 def Init():
 
-    global dmetric, fpcode
+    global dmetric, fpcode, bulkmetric, countmetric, store
 
     #check requested fingerprint existance
     if not fpcodes.has_key(fp):
@@ -56,23 +114,529 @@ def Init():
         print 'Implemented similarity measures: ', dmetrics.keys()
         raise KeyError('Unknown similarty measure')
 
+    if simkernel not in ('bulk', 'numpy', 'loop'):
+        raise KeyError('Unknown similarity kernel (mprms.simkernel): ' +
+                       str(simkernel))
+
     #set fingerprint type and similarity measure
     dmetric = dmetrics[measure]
-    fpcode = fpcodes[fp]
+    bulkmetric = bulkmetrics[measure]
+    countmetric = countmetrics[measure]
+    fpcode = MakeFPGenerators().get(fp, fpcodes[fp])
+    if fp == 'atompairs' and foldCounts:
+        countcode = fpcode
+        fpcode = lambda mol: FoldCountFP(countcode(mol))
+    ClearFPCache()
+    ClearSimCache()
+
+    if fpStore:
+        if fp == 'atompairs' and not foldCounts:
+            raise ValueError('The fingerprint store needs bit vector fingerprints')
+        if fp == 'rdkit':
+            # folded to a length that depends on the molecule
+            raise ValueError('The fingerprint store needs fixed length '
+                             'fingerprints')
+        from fpstore import FPStore
+        nbits = fpcode(Chem.MolFromSmiles('CC')).GetNumBits()
+        store = FPStore(fpStore, Signature(nbits), nbits,
+                        restart=mprms.restart)
 
     print "## Similarity scheme will be used:"
     print "## - Fingerprint: {}".format(fpcode)
     print "## - SimilarityM: {}".format(measure)
+    print "## - SimKernel  : {}".format(simkernel)
+    if fp == 'atompairs' and foldCounts:
+        print "## - Folded     : {} x {} bits".format(foldCounts, foldLevels)
 
     return 
 
 
-def FPDB(mols, fpcode):
+def Signature(nbits):
     '''
-import random
-Generate fingerprint database based on given fpcode
+    fields that identify the fingerprints of this run, for the fingerprint
+    store: type, the parameters it depends on and the number of bits
+    '''
+    signature = [fp]
+    if fp == 'morgan':
+        signature.append('radius={}'.format(morganradius))
+    if fp == 'atompairs':
+        signature.append('slots={}'.format(foldCounts))
+        signature.append('levels={}'.format(foldLevels))
+    signature.append('bits={}'.format(nbits))
+    return signature
+
+
+def MakeFPGenerators():
+    '''
+    Set up the fingerprint functions once, instead of for every molecule.
+    GetRDKFingerprint builds its FingerprinterDetails on every call, its
+    parameters are passed to RDKFingerprint directly so the fingerprints
+    (folded down to tgtDensity) stay the same. The Morgan generator gives
+    the same bits as GetMorganFingerprintAsBitVect. Atom pairs are left
+    out since the generator hashes them differently from
+    GetAtomPairFingerPrint.
+    '''
+    details = FingerprintMols.FingerprinterDetails()
+    rdkargs = (details.minPath, details.maxPath, details.fpSize,
+               details.bitsPerHash, details.useHs, details.tgtDensity,
+               details.minSize)
+    generators = {'rdkit': lambda mol: Chem.RDKFingerprint(mol, *rdkargs)}
+    if rdFingerprintGenerator is not None:
+        morgangen = rdFingerprintGenerator.GetMorganGenerator(
+            radius=morganradius, fpSize=2048)
+        generators['morgan'] = morgangen.GetFingerprint
+    return generators
+
+
+def FoldCountFP(cfp, nslots=None, levels=None):
+    '''
+    Fold a sparse count fingerprint into an ExplicitBitVect of
+    nslots * levels bits. Keys are spread over the slots by a
+    multiplicative hash (the low bits of the atom pair codes only hold the
+    distance), colliding keys add up their counts.
+    '''
+    if nslots is None: nslots = foldCounts
+    if levels is None: levels = foldLevels
+    counts = {}
+    for key, n in cfp.GetNonzeroElements().iteritems():
+        slot = (((key * 2654435761) & 0xffffffff) * nslots) >> 32
+        counts[slot] = counts.get(slot, 0) + n
+    bv = DataStructs.ExplicitBitVect(nslots * levels)
+    bv.SetBitsFromList([slot * levels + k for slot, n in counts.iteritems()
+                        for k in xrange(min(n, levels))])
+    return bv
+
+
+############################
+# Fingerprint cache (LRU)  #
+############################
+
+
+def ClearFPCache():
+    global _fpcachesize
+    _fpcache.clear()
+    _fpcachesize = 0
+
+
+def CachedFP(mol):
+    '''
+    Fingerprint of mol, looked up by its isosmi. Most pool molecules survive
+    several generations, so their fingerprints are only computed once.
+    The least recently used entries are evicted above fpCacheMB.
+    '''
+    global _fpcachesize
+    if not fpCacheMB or not mol.HasProp('isosmi'):
+        return fpcode(mol)
+    key = mol.GetProp('isosmi')
+
+    try:
+        # pop and reinsert to mark as most recently used
+        entry = _fpcache.pop(key)
+        output.Count('FP CACHE HIT')
+    except KeyError:
+        newfp = fpcode(mol)
+        entry = (newfp, len(key) + len(newfp.ToBinary()))
+        _fpcachesize += entry[1]
+        output.Count('FP CACHE MISS')
+    _fpcache[key] = entry
+
+    maxsize = fpCacheMB * 1024 * 1024
+    while _fpcachesize > maxsize and len(_fpcache) > 1:
+        oldkey, oldentry = _fpcache.popitem(last=False)
+        _fpcachesize -= oldentry[1]
+        output.Count('FP CACHE EVICT')
+
+    return entry[0]
+
+
+def FPDB(mols, code=None):
+    '''
+    Generate fingerprint database based on given fingerprint code.
+    The module fingerprint (default) is taken from the fingerprint cache.
+    '''
+    if code is not None and code is not fpcode:
+        return [code(mol) for mol in mols]
+    return [CachedFP(mol) for mol in mols]
+
+
+def IsBitVect(fps):
+    '''
+    bit vector fingerprints of one length, which can be packed (the rdkit
+    fingerprint is folded to a length that depends on the molecule)
+    '''
+    return (len(fps) > 0 and
+            isinstance(fps[0], DataStructs.ExplicitBitVect) and
+            len(set(f.GetNumBits() for f in fps)) == 1)
+
+
+def BulkFunction(fps):
+    '''
+    bulkmetric, or dmetric per pair if fps are bit vectors of different
+    lengths: RDKit folds the longer one of a pair to the length of the
+    other, the bulk functions refuse them
+    '''
+    if (len(fps) > 0 and isinstance(fps[0], DataStructs.ExplicitBitVect) and
+            len(set(f.GetNumBits() for f in fps)) > 1):
+        return lambda fp, others: [dmetric(fp, f) for f in others]
+    return bulkmetric
+
+
+def FPBitMatrix(fps):
+    '''
+    Pack bit vector fingerprints into a (n, nbits/8) uint8 array
+    '''
+    return np.array([np.frombuffer(DataStructs.BitVectToBinaryText(f),
+                                   dtype=np.uint8) for f in fps])
+
+
+def BitCounts(packed):
+    packed = packed.view(np.uint8)
+    return _popcount8[packed].sum(axis=1).astype(float)
+
+
+def CountSimilarity(c, a, b):
+    '''
+    Similarity from intersection and bit counts. Empty fingerprints give 0.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sim = countmetric(c, a, b)
+    return np.nan_to_num(sim)
+
+
+def BulkSimRow(i, fps, bulk=None):
+    '''
+    Similarities of fingerprint i to all fingerprints in fps
+    '''
+    if bulk is None:
+        bulk = BulkFunction(fps)
+    return np.array(bulk(fps[i], fps))
+
+
+def PackedSimRow(i, packed, counts):
+    '''
+    Similarities of packed fingerprint i to all packed fingerprints
+    '''
+    return PackedSims(packed[i], counts[i], packed, counts)
+
+
+def PackedSims(query, a, packed, counts):
+    '''
+    Similarities of a packed query fingerprint with a bits set
+    to the packed fingerprints
+    '''
+    c = _popcount8[(packed & query).view(np.uint8)].sum(axis=1)
+    return CountSimilarity(c.astype(float), a, counts)
+
+
+def SimBound(a, b):
+    '''
+    Upper bound of the similarity of fingerprints with a and b bits set
+    (BitBound). All measures increase with the intersection, which is at
+    most min(a, b); for tanimoto this gives min(a, b) / max(a, b).
+    '''
+    return CountSimilarity(np.minimum(a, b), a, b)
+
+
+def BitBoundRow(i, packed, counts, minsim):
+    '''
+    Similarities of fingerprint i to all fingerprints. Fingerprints that
+    cannot reach minsim because of their bit count are not compared and
+    get a similarity of -inf.
+    '''
+    a = counts[i]
+    cand = np.nonzero(SimBound(a, counts) >= minsim)[0]
+    row = np.empty(len(counts))
+    row.fill(-np.inf)
+    row[cand] = PackedSims(packed[i], a, packed[cand], counts[cand])
+    output.Count('BITBOUND PRUNED', len(counts) - len(cand))
+    return row
+
+
+def BitBoundNN(packed, counts, chunksize=64):
+    '''
+    Most similar other fingerprint of every fingerprint, using BitBound
+    pruning: the fingerprints are sorted by bit count and the candidates of
+    every query are visited outward from its own bit count, one chunk at a
+    time, until the bound of the next candidates cannot beat the best one.
+    Returns nearest neighbor similarities, their indices and the number of
+    pruned comparisons. A single fingerprint gets similarity -1.
+    '''
+    n = len(packed)
+    order = np.argsort(counts, kind='mergesort')
+    spacked = packed[order]
+    scounts = counts[order]
+
+    nnsim = -np.ones(n)
+    nnidx = -np.ones(n, dtype=int)
+    ncompared = 0
+    for p in xrange(n):
+        a = scounts[p]
+        best, bestj = -1.0, -1
+        up, down = p + 1, p - 1
+        while up < n or down >= 0:
+            bup = SimBound(a, scounts[up]) if up < n else -np.inf
+            bdown = SimBound(a, scounts[down]) if down >= 0 else -np.inf
+            if max(bup, bdown) <= best:
+                break
+            if bup >= bdown:
+                idx = np.arange(up, min(up + chunksize, n))
+                up += chunksize
+            else:
+                idx = np.arange(max(down - chunksize + 1, 0), down + 1)
+                down -= chunksize
+            sims = PackedSims(spacked[p], a, spacked[idx], scounts[idx])
+            ncompared += len(idx)
+            j = np.argmax(sims)
+            if sims[j] > best:
+                best, bestj = sims[j], idx[j]
+        nnsim[order[p]] = best
+        if bestj >= 0:
+            nnidx[order[p]] = order[bestj]
+
+    npruned = n * (n - 1) - ncompared
+    output.Count('BITBOUND PRUNED', npruned)
+    return nnsim, nnidx, npruned
+
+
+class PackedFPs(object):
+    '''
+    Packed bit vector fingerprints of a set of molecules. Similarity rows
+    are computed on demand, fps[i] works like a row of the dense similarity
+    matrix (with -1 on the diagonal).
+    '''
+    def __init__(self, packed, counts=None):
+        self.packed = packed
+        if counts is None:
+            counts = BitCounts(packed)
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, i):
+        return self.Row(i)
+
+    def Row(self, i, minsim=None):
+        if minsim is None:
+            row = PackedSimRow(i, self.packed, self.counts)
+        else:
+            row = BitBoundRow(i, self.packed, self.counts, minsim)
+        row[i] = -1
+        return row
+
+    def Neighbors(self, i, minsim):
+        '''
+        Sparse row: indices and similarities of the fingerprints with a
+        similarity of at least minsim to fingerprint i (i itself excluded)
+        '''
+        a = self.counts[i]
+        cand = np.nonzero(SimBound(a, self.counts) >= minsim)[0]
+        cand = cand[cand != i]
+        sims = PackedSims(self.packed[i], a, self.packed[cand],
+                          self.counts[cand])
+        output.Count('BITBOUND PRUNED', len(self.counts) - len(cand))
+        keep = sims >= minsim
+        return cand[keep], sims[keep]
+
+    def NearestNeighbors(self):
+        return BitBoundNN(self.packed, self.counts)
+
+
+def GetPackedFPs(mols):
+    '''
+    PackedFPs of mols, None if the fingerprints are not bit vectors
+    '''
+    if store is not None:
+        return PackedFPs(*store.Packed(mols, fpcode))
+    fps = FPDB(mols)
+    if not IsBitVect(fps):
+        return None
+    return PackedFPs(FPBitMatrix(fps))
+
+
+def NumpyFPSimMatrix(fps, blocksize=None):
+    '''
+    Similarity matrix of bit vector fingerprints with NumPy.
+    '''
+    return PackedSimMatrix(FPBitMatrix(fps), blocksize=blocksize)
+
+
+def PackedSimMatrix(packed, counts=None, blocksize=None):
+    '''
+    Similarity matrix of packed bit vector fingerprints (uint8 or uint64 rows).
+    The intersection counts are obtained as a matrix product of the unpacked
+    bits, computed in blocks of rows to limit the memory usage.
     '''
-    return [fpcode(mol) for mol in mols]
+    if nWorkers > 1:
+        return ParallelSimMatrix(packed=packed, counts=counts)
+
+    n = len(packed)
+    sim = np.empty((n, n))
+    for start, block in PackedSimBlocks(packed, counts, blocksize):
+        sim[start:start + len(block)] = block
+    return sim
+
+
+def PackedSimBlocks(packed, counts=None, blocksize=None):
+    '''
+    Yield (start, block): similarities of the rows start:start+len(block)
+    to all packed fingerprints
+    '''
+    if blocksize is None:
+        blocksize = simBlockSize
+    if counts is None:
+        counts = BitCounts(packed)
+    bits = np.unpackbits(packed.view(np.uint8), axis=1).astype(np.float32)
+
+    for start in xrange(0, len(packed), blocksize):
+        stop = min(start + blocksize, len(packed))
+        c = np.dot(bits[start:stop], bits.T).astype(float)
+        yield start, CountSimilarity(c, counts[start:stop, None], counts)
+
+
+def SimBlocks(mols, blocksize=None):
+    '''
+    Yield (start, block) with the similarities of the rows
+    start:start+len(block) to all molecules, diagonal terms set to -1.
+    Only one block of rows is kept in memory at a time.
+    '''
+    if blocksize is None:
+        blocksize = simBlockSize
+    if store is not None:
+        packed, counts = store.Packed(mols, fpcode)
+        blocks = PackedSimBlocks(packed, counts, blocksize)
+    else:
+        fps = FPDB(mols)
+        if simkernel == 'numpy' and IsBitVect(fps):
+            blocks = PackedSimBlocks(FPBitMatrix(fps), blocksize=blocksize)
+        else:
+            bulk = BulkFunction(fps)
+            blocks = ((start, np.array([bulk(fps[i], fps) for i in
+                                        xrange(start, min(start + blocksize, len(fps)))]))
+                      for start in xrange(0, len(fps), blocksize))
+
+    for start, block in blocks:
+        irow = np.arange(len(block))
+        block[irow, irow + start] = -1
+        yield start, block
+
+
+def SimNeighborGraph(mols, k=1, threshold=None, blocksize=None):
+    '''
+    Sparse neighbor graph (scipy csr matrix) of the similarities, built in
+    row blocks: either the k most similar molecules of every molecule, or
+    all pairs with a similarity of at least threshold.
+    For a single molecule the only neighbor is itself (similarity -1).
+    '''
+    from scipy import sparse
+
+    n = len(mols)
+    k = min(k, n)
+    rows, cols, vals = [], [], []
+    for start, block in SimBlocks(mols, blocksize):
+        if threshold is not None:
+            r, c = np.nonzero(block >= threshold)
+        else:
+            c = np.argpartition(-block, k - 1, axis=1)[:, :k].ravel()
+            r = np.repeat(np.arange(len(block)), k)
+        rows.append(r + start)
+        cols.append(c)
+        vals.append(block[r, c])
+
+    return sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n, n))
+
+
+def FPSimMatrix(fps, kernel=None):
+    '''
+    Compute similarity matrix of a fingerprint database.
+    Diagonal terms are set to be -1
+    '''
+    if kernel is None:
+        kernel = simkernel
+    n = len(fps)
+
+    if kernel == 'numpy' and IsBitVect(fps):
+        sim = NumpyFPSimMatrix(fps)
+    elif kernel == 'loop':
+        sim = np.zeros((n, n))
+        for i in range(1, n):
+            for j in range(i):
+                sim_ij = dmetric(fps[i], fps[j])
+                sim[i, j] = sim_ij
+                sim[j, i] = sim[i, j]
+    elif nWorkers > 1:
+        sim = ParallelSimMatrix(fps=fps)
+    else:
+        # one bulk call per row for the lower triangle
+        bulk = BulkFunction(fps)
+        sim = np.zeros((n, n))
+        for i in xrange(1, n):
+            row = bulk(fps[i], fps[:i])
+            sim[i, :i] = row
+            sim[:i, i] = row
+
+    np.fill_diagonal(sim, -1)
+    return sim
+
+
+def _SimMatrixBlock(rows):
+    '''
+    Worker: fill rows start:stop of the shared similarity matrix
+    '''
+    start, stop = rows
+    sim = _worker['sim']
+    if 'bits' in _worker:
+        bits, counts = _worker['bits'], _worker['counts']
+        c = np.dot(bits[start:stop], bits.T).astype(float)
+        sim[start:stop] = CountSimilarity(c, counts[start:stop, None], counts)
+    else:
+        # lower triangle only, every pair is written by the owner of row i
+        fps, bulk = _worker['fps'], _worker['bulk']
+        for i in xrange(max(start, 1), stop):
+            row = bulk(fps[i], fps[:i])
+            sim[i, :i] = row
+            sim[:i, i] = row
+    return stop - start
+
+
+def ParallelSimMatrix(fps=None, packed=None, counts=None, nproc=None):
+    '''
+    Similarity matrix computed by a local process pool. The rows are
+    split into blocks of (about) equal work and the workers write straight
+    into a shared memory matrix instead of sending rows back.
+    Either RDKit fingerprints (bulk kernel) or packed bit vectors are used.
+    '''
+    import parallel as pl
+    if nproc is None:
+        nproc = nWorkers
+    nblock = 4 * nproc
+
+    if packed is not None:
+        n = len(packed)
+        if counts is None:
+            counts = BitCounts(packed)
+        _worker['bits'] = np.unpackbits(packed.view(np.uint8),
+                                        axis=1).astype(np.float32)
+        _worker['counts'] = counts
+        bounds = [n * k // nblock for k in xrange(nblock + 1)]
+    else:
+        n = len(fps)
+        _worker['fps'] = fps
+        _worker['bulk'] = BulkFunction(fps)
+        # row i costs i comparisons
+        bounds = [int(n * np.sqrt(k * 1.0 / nblock)) for k in xrange(nblock + 1)]
+    sim = pl.SharedArray((n, n))
+    _worker['sim'] = sim
+
+    blocks = [(bounds[k], bounds[k + 1]) for k in xrange(nblock)
+              if bounds[k + 1] > bounds[k]]
+    try:
+        pl.PoolMap(_SimMatrixBlock, blocks, nproc)
+    finally:
+        _worker.clear()
+    return sim
 
 
 def GenFPSimMatrix(mols):
@@ -82,23 +646,99 @@ def GenFPSimMatrix(mols):
     Note: lingo will produce fatal errors for molecules of less than 3 atoms.
     We either need special cases to handle this or just not use lingo.
     '''
+    if store is not None:
+        packed, counts = store.Packed(mols, fpcode)
+        sim = PackedSimMatrix(packed, counts)
+        np.fill_diagonal(sim, -1)
+        return sim
+
     #get the fingerprint database
-    fps = FPDB(mols, fpcode)
+    fps = FPDB(mols)
 
-    n = len(mols)
-    sim = np.zeros((n, n))
-    #diagonal terms are set to be -1
-    for i in range(n):
-        sim[i, i] = -1
-    #off-diagonal terms
-    for i in range(1, n):
-        for j in range(i):
-            sim_ij = dmetric(fps[i], fps[j])
-            sim[i, j] = sim_ij
-            sim[j, i] = sim[i, j]
+    return FPSimMatrix(fps)
+
+
+###################################
+# Per-generation similarity cache #
+###################################
+
+
+def ClearSimCache():
+    _simcache['index'] = {}
+    _simcache['matrix'] = None
+
+
+def CacheSims(mols, sim):
+    '''
+    Keep the similarity matrix sim of mols for the rest of the generation,
+    so the library diversity can be sliced out of it instead of being
+    computed again. Replaces the previous matrix.
+    '''
+    _simcache['index'] = dict((mol.GetProp('isosmi'), i)
+                              for i, mol in enumerate(mols)
+                              if mol.HasProp('isosmi'))
+    _simcache['matrix'] = sim
+
+
+def CachedSimMatrix(mols):
+    '''
+    Similarity matrix of mols (diagonal -1) sliced from the cached matrix.
+    Rows of molecules that are not in the cache are computed, None is
+    returned if that would be most of them.
+    '''
+    cached = _simcache['matrix']
+    if cached is None or len(mols) == 0:
+        return None
+    index = _simcache['index']
+    ref = np.array([index.get(mol.GetProp('isosmi'), -1)
+                    if mol.HasProp('isosmi') else -1 for mol in mols])
+    missing = np.nonzero(ref < 0)[0]
+    if 2 * len(missing) > len(mols):
+        output.Count('SIM CACHE MISS')
+        return None
+    output.Count('SIM CACHE HIT')
+
+    inref = np.nonzero(ref >= 0)[0]
+    sim = np.empty((len(mols), len(mols)))
+    sim[np.ix_(inref, inref)] = cached[np.ix_(ref[inref], ref[inref])]
+    if len(missing) > 0:
+        simrow = SimRowFunction(mols)
+        for i in missing:
+            row = simrow(i)
+            sim[i] = row
+            sim[:, i] = row
+    np.fill_diagonal(sim, -1)
     return sim
 
 
+def MaximinPicks(simrow, n, nMol, firstpick=None):
+    '''
+    Incremental maximin selection engine working on similarities
+
+    simrow(i) has to return the similarities of molecule i to all n
+    molecules. For every candidate we keep the maximum similarity to the
+    already selected set and update it with one row operation per pick,
+    so the cost is O(n*nMol) instead of O(n*nMol**2).
+    Ties are resolved to the lowest index, as in the original loop.
+    '''
+    if nMol <= 0 or n == 0:
+        return []
+    if firstpick is None:
+        # initially pick a random molecule
+        firstpick = random.randrange(0, n, 1)
+    picks = [firstpick]
+
+    maxsim = np.array(simrow(firstpick), dtype=float)
+    maxsim[firstpick] = np.inf
+    for i in xrange(nMol - 1):
+        nextpick = int(np.argmin(maxsim))
+        picks.append(nextpick)
+        np.maximum(maxsim, simrow(nextpick), out=maxsim)
+        # selected molecules can never be picked again
+        maxsim[nextpick] = np.inf
+    return picks
+
+
 def FPMaximin(mols, nMol, sim=None):
     '''
     Maximin maximum diversity selection using fingerprint similarity as a
@@ -106,46 +746,87 @@ def FPMaximin(mols, nMol, sim=None):
     It's currently coded to work with similarity rather than dissimilarity
     also only for things where we don't have descriptors, just pairwise distance
     
-    If no similarity matrix is specified, it will calculate simialarity matrix
-    first (i.e., the explicit similarity matrix is not stored)
+    If no similarity matrix is specified, only the similarity rows of the
+    picked molecules are calculated (i.e., the explicit similarity matrix
+    is not stored)
     '''
-    if sim is None:
-        #different from previous version of Maximin in OPENEYE-ACSESS
-        if dmetric is None or fpcode is None:
-            print 'Need to assign fingerprint and similarity measure'
-            raise KeyError('Unassigned parameters')
-        else:
-            sim = GenFPSimMatrix(mols)
+    if nMol > len(mols):
+        print 'ERROR: requested subset is larger than parent library.'
+        raise Exception
 
+    if sim is not None:
+        picks = MaximinPicks(lambda i: sim[i], len(mols), nMol)
+        return [mols[i] for i in picks]
+
+    #different from previous version of Maximin in OPENEYE-ACSESS
+    if dmetric is None or fpcode is None:
+        print 'Need to assign fingerprint and similarity measure'
+        raise KeyError('Unassigned parameters')
+    simrow = SimRowFunction(mols)
+
+    # keep the similarities among the picks (each row against the earlier
+    # picks), they are the similarity matrix of the new library
+    picked = []
+    lower = []
+    def pickrow(i):
+        row = simrow(i)
+        lower.append(np.asarray(row, dtype=float)[picked])
+        picked.append(i)
+        return row
+
+    picks = MaximinPicks(pickrow, len(mols), nMol)
+
+    libsim = np.empty((len(picks), len(picks)))
+    for k, row in enumerate(lower):
+        libsim[k, :k] = row
+        libsim[:k, k] = row
+    np.fill_diagonal(libsim, -1)
+    lib = [mols[i] for i in picks]
+    CacheSims(lib, libsim)
+    return lib
+
+
+def SimRowFunction(mols):
+    '''
+    simrow(i): similarities of molecule i to all mols, from the
+    fingerprint store or the fingerprint cache
+    '''
+    if store is not None:
+        packed, counts = store.Packed(mols, fpcode)
+        return lambda i: PackedSimRow(i, packed, counts)
+    fps = FPDB(mols)
+    bulk = BulkFunction(fps)
+    return lambda i: BulkSimRow(i, fps, bulk)
+
+
+def FPSphereExclusion(mols, nMol, radius=None):
+    '''
+    Sphere exclusion (leader) selection with 1 - similarity as distance.
+    See sphereexclusion.py
+    '''
+    from sphereexclusion import SphereExclusionPicks, CalibrateRadius
     if nMol > len(mols):
         print 'ERROR: requested subset is larger than parent library.'
         raise Exception
 
-    selected = [False] * len(mols)
-    newmols = []
-    for i in range(nMol):
-        if i == 0:
-            # initially pick a random molecule
-            minsimmol = random.randrange(0, len(mols), 1)
-            minsim = 0.0
-        else:
-            minsim = 2.0
-            for i in range(len(mols)):
-                if selected[i]:
-                    continue
-                maxsim = -1.0
-                for j in newmols:
-                    if sim[i, j] > maxsim:
-                        maxsim = sim[i, j]
-                if maxsim < minsim:
-                    minsim = maxsim
-                    minsimmol = i
-        newmols.append(minsimmol)
-        selected[minsimmol] = True
-    for i in range(len(newmols)):
-        newmols[i] = mols[newmols[i]]
-
-    return newmols
+    fps = GetPackedFPs(mols)
+    if fps is not None:
+        distrows = lambda i, idx: 1.0 - PackedSims(
+            fps.packed[i], fps.counts[i], fps.packed[idx], fps.counts[idx])
+    else:
+        fplist = FPDB(mols)
+        bulk = BulkFunction(fplist)
+        distrows = lambda i, idx: 1.0 - np.array(
+            bulk(fplist[i], [fplist[j] for j in idx]))
+
+    if radius is None:
+        radius = sphereRadius
+    if radius is None:
+        radius = CalibrateRadius(distrows, len(mols), nMol)
+    print 'Sphere exclusion radius (1-similarity):', radius
+
+    picks = SphereExclusionPicks(distrows, len(mols), nMol, radius)
+    return [mols[i] for i in picks]
 
 
 def NNSimilarity(mols, sim=None, average=False):
@@ -157,10 +838,21 @@ def NNSimilarity(mols, sim=None, average=False):
     Calculate average nearest neighbor similarity
     (a diverse library should MINIMIZE this function)
     '''
+    if sim is None:
+        sim = CachedSimMatrix(mols)
     if sim is None:
         if dmetric is None or fpcode is None:
             print 'Need to assign fingerprint and similarity measure'
             raise KeyError('Unassigned parameters')
+        if bitBoundNN and not average:
+            fps = GetPackedFPs(mols)
+            if fps is not None:
+                nnsim, nnidx, npruned = fps.NearestNeighbors()
+                print 'BitBound NN search pruned {} of {} comparisons'.format(
+                    npruned, len(mols) * (len(mols) - 1))
+                return nnsim.sum() / len(mols)
+        if sparseNNSize and len(mols) > sparseNNSize:
+            return SparseNNSimilarity(mols, average)
         else:
             sim = GenFPSimMatrix(mols)
 
@@ -172,3 +864,24 @@ def NNSimilarity(mols, sim=None, average=False):
         for imol in range(len(mols)):
             div += sim[imol].max()
         return div / len(mols)
+
+
+def SparseNNSimilarity(mols, average=False):
+    '''
+    NNSimilarity without building the dense similarity matrix.
+    The nearest neighbors come from a top-1 neighbor graph, the
+    average over all pairs is summed up block by block.
+    '''
+    n = len(mols)
+    if average:
+        if n < 2:
+            return np.nan
+        total = 0.0
+        for start, block in SimBlocks(mols):
+            # remove the diagonal terms (-1)
+            total += block.sum() + len(block)
+        return total / (n * (n - 1))
+    else:
+        graph = SimNeighborGraph(mols, k=1)
+        maxsim = np.maximum.reduceat(graph.data, graph.indptr[:-1])
+        return maxsim.sum() / n
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+Sphere exclusion (leader) selection, a fast alternative to maximin.
+
+Molecules are visited in random order. A molecule becomes a leader if it is
+further than the radius from all leaders, and then excludes every remaining
+candidate within the radius. Distances are only computed between the new
+leader and the candidates that are still left, so the work shrinks with
+every pick instead of scaling with pool size times subset size.
+
+The engine works on a distance function distrows(i, idx), returning the
+distances of molecule i to the molecules idx, so it can be used for both
+descriptor coordinates and fingerprint (dis)similarities.
+'''
+import random
+import numpy as np
+
+
+def SphereExclusionPicks(distrows, n, nMol, radius, shrink=0.8, order=None):
+    '''
+    Pick up to nMol leaders. If all candidates are excluded before nMol
+    leaders are found, the radius is multiplied by shrink and the non-picked
+    molecules are screened again against all leaders (shrink=None stops).
+    '''
+    if order is None:
+        order = np.array(random.sample(xrange(n), n), dtype=int)
+    picks = []
+    cand = order
+    while True:
+        while len(cand) > 0 and len(picks) < nMol:
+            ipick = cand[0]
+            picks.append(int(ipick))
+            cand = cand[1:]
+            cand = cand[distrows(ipick, cand) > radius]
+
+        if len(picks) >= nMol or len(picks) == n or not shrink:
+            break
+
+        # pool exhausted: shrink the sphere and screen the rest again
+        radius *= shrink
+        picked = np.zeros(n, dtype=bool)
+        picked[picks] = True
+        rest = order[~picked[order]]
+        if radius < 1e-10:
+            # only duplicates of the picks are left
+            cand = rest
+            continue
+        mindist = np.empty(len(rest))
+        mindist.fill(np.inf)
+        for ipick in picks:
+            mindist = np.minimum(mindist, distrows(ipick, rest))
+        cand = rest[mindist > radius]
+
+    return picks
+
+
+def CalibrateRadius(distrows, n, nMol, nIter=12):
+    '''
+    Estimate the largest radius that still gives nMol leaders, by bisection
+    on a random sample. The number of leaders depends on how many spheres
+    cover the occupied space, not on the density, so the sample only has to
+    be large compared to nMol.
+    '''
+    nSample = min(n, max(1000, 4 * nMol))
+    sample = np.array(random.sample(xrange(n), nSample), dtype=int)
+    subrows = lambda i, idx: distrows(sample[i], sample[idx])
+    order = np.arange(nSample)
+
+    lo = 0.0
+    hi = 2.0 * np.max(subrows(0, order))
+    if hi <= 0.0:
+        return 0.0
+    for i in xrange(nIter):
+        radius = 0.5 * (lo + hi)
+        nleaders = len(SphereExclusionPicks(subrows, nSample, nMol, radius,
+                                            shrink=None, order=order))
+        if nleaders >= nMol:
+            lo = radius
+        else:
+            hi = radius
+    return lo
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+Coordinates computed from molecules through distance.SetCoords and kept in
+the coordinate store. Run from the repository directory with
+    python -m unittest discover tests
+'''
+import os
+import sys
+import types
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+os.environ.setdefault('USER', 'test')  # scratch location in helpers
+if 'mprms' not in sys.modules:
+    # the run parameters are read from mprms.py in the run directory
+    sys.modules['mprms'] = types.ModuleType('mprms')
+
+from rdkit import Chem
+import distance
+from coordstore import CoordStore
+
+
+def AtomCounts(mol):
+    return [mol.GetNumAtoms(), mol.GetNumBonds()]
+
+
+class SetCoordsTest(unittest.TestCase):
+    smiles = ['C', 'CC', 'CCO', 'c1ccccc1', 'CC(=O)O', 'CCN(CC)CC']
+
+    def setUp(self):
+        self.store = distance.coordstore
+        self.coords = getattr(distance, 'Coords', None)
+        # a store that has to grow several times
+        distance.coordstore = CoordStore(growby=2)
+        distance.Coords = AtomCounts
+        self.mols = [Chem.MolFromSmiles(smi) for smi in self.smiles]
+
+    def tearDown(self):
+        distance.coordstore = self.store
+        distance.Coords = self.coords
+
+    def testSetCoords(self):
+        for mol in self.mols:
+            self.assertEqual(list(distance.SetCoords(mol)), AtomCounts(mol))
+        # stored: the same rows again
+        for mol in self.mols:
+            self.assertEqual(list(distance.SetCoords(mol)), AtomCounts(mol))
+        self.assertEqual(len(distance.coordstore), len(self.mols))
+
+    def testGetCoordArray(self):
+        coords = distance.GetCoordArray(self.mols)
+        np.testing.assert_array_equal(coords,
+                                      [AtomCounts(mol) for mol in self.mols])
+
+    def testMPICoordCalc(self):
+        # the workers only compute, the master stores
+        for smi, mol in zip(self.smiles, self.mols):
+            self.assertEqual(list(distance.MPICoordCalc(smi)), AtomCounts(mol))
+        self.assertEqual(len(distance.coordstore), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
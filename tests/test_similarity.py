@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+Similarity matrices of the default (rdkit) fingerprint, whose length depends
+on the molecule, through the bulk, numpy and per pair kernels. Run from the
+repository directory with
+    python -m unittest discover tests
+'''
+import os
+import sys
+import types
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+os.environ.setdefault('USER', 'test')  # scratch location in helpers
+if 'mprms' not in sys.modules:
+    # the run parameters are read from mprms.py in the run directory
+    sys.modules['mprms'] = types.ModuleType('mprms')
+
+from rdkit import Chem
+import similarity
+
+
+class DefaultFingerprintTest(unittest.TestCase):
+    smiles = ['C', 'CC', 'CCO', 'c1ccccc1', 'CC(=O)Oc1ccccc1C(=O)O',
+              'CCN(CC)CCNC(=O)c1ccc(N)cc1', 'CN1CCC23C4Oc5c3c(CC1C2C=CC4O)ccc5O']
+
+    def setUp(self):
+        self.params = (similarity.fp, similarity.measure, similarity.fpStore,
+                       similarity.nWorkers)
+        similarity.fp, similarity.measure = 'rdkit', 'tanimoto'
+        similarity.fpStore, similarity.nWorkers = '', 1
+        similarity.Init()
+        self.mols = [Chem.MolFromSmiles(smi) for smi in self.smiles]
+        self.fps = similarity.FPDB(self.mols)
+
+    def tearDown(self):
+        (similarity.fp, similarity.measure, similarity.fpStore,
+         similarity.nWorkers) = self.params
+        similarity.Init()
+
+    def testLengthsDiffer(self):
+        self.assertTrue(len(set(f.GetNumBits() for f in self.fps)) > 1)
+        self.assertFalse(similarity.IsBitVect(self.fps))
+
+    def testKernels(self):
+        loop = similarity.FPSimMatrix(self.fps, 'loop')
+        for kernel in ('bulk', 'numpy'):
+            np.testing.assert_allclose(
+                similarity.FPSimMatrix(self.fps, kernel), loop)
+
+    def testSimBlocks(self):
+        loop = similarity.FPSimMatrix(self.fps, 'loop')
+        for start, block in similarity.SimBlocks(self.mols, blocksize=3):
+            np.testing.assert_allclose(block, loop[start:start + len(block)])
+
+    def testSimRows(self):
+        loop = similarity.FPSimMatrix(self.fps, 'loop')
+        row = similarity.SimRowFunction(self.mols)
+        for i in xrange(len(self.mols)):
+            sim = row(i)
+            sim[i] = -1
+            np.testing.assert_allclose(sim, loop[i])
+
+
+if __name__ == '__main__':
+    unittest.main()